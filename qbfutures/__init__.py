@@ -5,10 +5,19 @@ if os.environ.get('READTHEDOCS', None) == 'True':
     import sys
     sys.modules['qb'] = sys.modules[__name__]
 
-from core import Executor, Future
+# Run against a simulated farm on this host; see qbfutures.localfarm.
+if os.environ.get('QBFUTURES_LOCALFARM') or os.environ.get('QBFUTURES_LOCALFARM_ADDRESS'):
+    from . import localfarm
+    localfarm.install()
+
+from core import Executor, Future, cancel, statuses
+from utils import Continuation
 
 # Silence pyflakes.
+assert Continuation
 assert Future
+assert cancel
+assert statuses
 
 _main = Executor()
 submit = _main.submit
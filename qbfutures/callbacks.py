@@ -0,0 +1,159 @@
+"""Control which thread runs the done callbacks of :class:`~qbfutures.Future`.
+
+Futures are finished by the poller, so by default their done callbacks run on
+the poller's thread, and a slow callback delays every other future and the next
+poll. Instead, callbacks may be dispatched to a pool of threads::
+
+    >>> qbfutures.callbacks.set_dispatcher(qbfutures.callbacks.ThreadPoolDispatcher(4))
+
+(or set ``QBFUTURES_CALLBACK_THREADS``), or queued for a GUI's main loop to run::
+
+    >>> dispatcher = qbfutures.callbacks.QueueDispatcher()
+    >>> qbfutures.callbacks.set_dispatcher(dispatcher)
+    >>> # e.g. in a Maya idle event, or when dispatcher.fileno() is readable:
+    >>> dispatcher.drain()
+
+How long each callback takes is recorded in :mod:`qbfutures.metrics`.
+
+"""
+
+from __future__ import absolute_import
+
+import fcntl
+import os
+import Queue as queue
+import threading
+import time
+
+from concurrent.futures import _base
+
+from . import metrics
+
+
+_callback_seconds = metrics.histogram('qbfutures_callback_seconds', 'Time spent in each done callback.')
+_callback_errors = metrics.counter('qbfutures_callback_errors_total', 'Done callbacks which raised an exception.')
+
+
+def run_callback(fn, future):
+    """Call a done callback, timing it and logging any exception."""
+    start = time.time()
+    try:
+        fn(future)
+    except Exception:
+        _callback_errors.inc()
+        _base.LOGGER.exception('exception calling callback for %r', future)
+    finally:
+        _callback_seconds.observe(time.time() - start)
+
+
+class InlineDispatcher(object):
+
+    """Runs callbacks immediately, on whichever thread finished the future."""
+
+    def dispatch(self, fn, future):
+        run_callback(fn, future)
+
+    def pending(self):
+        return 0
+
+
+class ThreadPoolDispatcher(object):
+
+    """Runs callbacks on a pool of daemon threads."""
+
+    def __init__(self, workers=4):
+        self.queue = queue.Queue()
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker, name='qbfutures-callbacks-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self, fn, future):
+        self.queue.put((fn, future))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _worker(self):
+        while True:
+            fn, future = self.queue.get()
+            run_callback(fn, future)
+            del fn, future
+
+
+class QueueDispatcher(object):
+
+    """Queues callbacks until :meth:`drain` is called, e.g. from a main loop.
+
+    :meth:`fileno` is readable whenever there are callbacks waiting, so it may
+    be watched by ``select`` or a ``QSocketNotifier``.
+
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._read_fd
+
+    def dispatch(self, fn, future):
+        self.queue.put((fn, future))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError:
+            # The pipe is full, so it is certainly readable.
+            pass
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def drain(self, max_callbacks=None, timeout=0):
+        """Run waiting callbacks on this thread.
+
+        :param int max_callbacks: Stop after this many, leaving the rest.
+        :param float timeout: How long to wait for the first callback.
+        :returns: How many callbacks were run.
+
+        """
+        count = 0
+        while max_callbacks is None or count < max_callbacks:
+            try:
+                fn, future = self.queue.get(bool(timeout) and not count, timeout or None)
+            except queue.Empty:
+                break
+            run_callback(fn, future)
+            count += 1
+
+        # Clear the wakeup, but leave it set if anything is still waiting.
+        try:
+            os.read(self._read_fd, 4096)
+        except OSError:
+            pass
+        if not self.queue.empty():
+            try:
+                os.write(self._write_fd, 'x')
+            except OSError:
+                pass
+
+        return count
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        threads = int(os.environ.get('QBFUTURES_CALLBACK_THREADS') or 0)
+        set_dispatcher(ThreadPoolDispatcher(threads) if threads else InlineDispatcher())
+    return _dispatcher
+
+
+def set_dispatcher(dispatcher):
+    """Set how done callbacks are run for every future."""
+    global _dispatcher
+    _dispatcher = dispatcher
+    metrics.gauge('qbfutures_callback_queue_depth', 'Done callbacks waiting to run.', dispatcher.pending)
@@ -1,10 +1,15 @@
+import collections
 import itertools
 import os
+import pstats
+import Queue as queue
 import time
 import sys
+import threading
+import weakref
 
 try:
-    from concurrent.futures import _base
+    from concurrent.futures import _base, as_completed, wait as wait_for
 except ImportError:
     print 'COULD NOT FIND CONCURRENT.FUTURES'
     for x in sorted(os.environ.iteritems()):
@@ -16,15 +21,46 @@ except ImportError:
     
 import qb
 
+from . import callbacks
+from . import memo
+from . import metrics
+from . import spool
 from . import utils
 from . import poller
+from . import polld
 
-__also_reload = ['.utils', '.poller']
+__also_reload = ['.callbacks', '.memo', '.metrics', '.spool', '.utils', '.poller', '.polld']
 
 
-# Create one poller.
-_poller = poller.Poller()
-del poller
+# Create one poller, which will use the host's polling daemon if there is one.
+_poller = poller.Poller(daemon_path=polld.get_socket_path())
+_poller.register_gauges()
+
+
+def _reset_poller():
+    """Stop polling in this process, leaving a fresh poller for later submits.
+    
+    Any futures still being watched are abandoned without finishing.
+    
+    """
+    global _poller
+    if _poller.started:
+        _poller.shutdown()
+        _poller = poller.Poller(daemon_path=polld.get_socket_path())
+        _poller.register_gauges()
+
+
+_submit_seconds = metrics.histogram('qbfutures_executor_submit_seconds', 'Latency of qb.submit calls.')
+_submitted_work = metrics.counter('qbfutures_executor_submitted_work_total', 'Work items submitted to Qube.')
+_hedged_work = metrics.counter('qbfutures_executor_hedged_work_total', 'Straggling work items which were duplicated.')
+_hedge_wins = metrics.counter('qbfutures_executor_hedge_wins_total', 'Duplicated work items which finished first.')
+
+
+def _qb_submit(jobs):
+    with _submit_seconds.time():
+        submitted = qb.submit(jobs)
+    _submitted_work.inc(sum(len(job['agenda']) for job in jobs))
+    return submitted
 
 
 class Future(_base.Future):
@@ -39,26 +75,521 @@ class Future(_base.Future):
         
         #: The index of this work item into the job's agenda.
         self.work_id = work_id
+        
+        #: The last known state of the Qube job, as returned by ``qb.jobinfo``.
+        #: This is kept up to date by the poller while the future is pending.
+        self.job = None
+        
+        #: The last known state of the work item; its row of the job's agenda.
+        self.work = None
+        
+        #: The seconds spent in each phase of the work item on the farm, once
+        #: finished: ``spawn``, ``preflight``, ``unpack``, ``execute``,
+        #: ``pickle``, and ``pack``. Phases which didn't happen are missing.
+        self.timings = None
+        
+        # Raw cProfile stats, if requested via the ``profile`` extra.
+        self._profile = None
+        
+        # Our own callbacks, which are cheap and must not wait on a dispatcher.
+        self._inline_callbacks = []
+        
+        # If other work has been submitted which depends on our result.
+        self._referenced = False
+        
+        # The attempts at our work item, if it has been duplicated.
+        self._hedge = None
+        
+        # The packed result from Qube, which is not unpacked until someone
+        # asks for it.
+        self._resultpackage = None
+        
+        # If our result is to be stored in the memo, and the package to store;
+        # see Executor._memo_remember.
+        self._memoize = False
+        self._memo_package = None
     
     def __repr__(self):
-        res = super(Future, self).__repr__()
+        with self._condition:
+            if self._unpack_pending():
+                # Whether it raised is not known until it is unpacked.
+                res = '<%s at %#x state=finished (result not yet unpacked)>' % (self.__class__.__name__, id(self))
+            else:
+                res = super(Future, self).__repr__()
         if res.startswith('<Future '):
             res = ('<qbfutures.Future %d:%d ' % (self.job_id, self.work_id)) + res[8:]
         return res
     
-    def status(self):
-        """Get the current status for this particular work item."""
-        job = qb.jobinfo(id=[self.job_id])
-        return job[0]['agenda'][self.work_id]['status']
+    def _add_inline_callback(self, fn):
+        with self._condition:
+            if self._state not in (_base.CANCELLED, _base.CANCELLED_AND_NOTIFIED, _base.FINISHED):
+                self._inline_callbacks.append(fn)
+                return
+        fn(self)
+    
+    def _invoke_callbacks(self):
+        for fn in self._inline_callbacks:
+            callbacks.run_callback(fn, self)
+        # Others are run as the user has configured; see qbfutures.callbacks.
+        dispatcher = callbacks.get_dispatcher()
+        for fn in self._done_callbacks:
+            dispatcher.dispatch(fn, self)
+    
+    def set_resultpackage(self, package):
+        """Finish with a packed result from Qube, without unpacking it.
+        
+        Should only be used by the poller. The package will be unpacked upon
+        the first call to :meth:`result` or :meth:`exception`.
+        
+        """
+        package = package or {}
+        
+        # Our call handed off to a follow-up call; wait for that instead.
+        continuation = package.get('continuation')
+        if continuation and package.get('status') == 'complete':
+            self._continue(continuation)
+            return
+        
+        # Our work may have been duplicated, in which case the first attempt
+        # to succeed finishes us.
+        if self._hedge is not None:
+            self._hedge.settle(self, package)
+            return
+        
+        self._set_resultpackage(package)
+    
+    def _set_resultpackage(self, package):
+        self._resultpackage = package
+        if self._memoize:
+            self._memo_package = package
+        self.timings = package.get('timings')
+        if 'spool' in package and not self._referenced:
+            spool.remove_with(self, package['spool'])
+        if 'exception' in package or package.get('status') != 'complete':
+            self.set_exception(None)
+        else:
+            self.set_result(None)
+    
+    def _continue(self, continuation):
+        self.job_id = continuation['job_id']
+        self.work_id = continuation['work_id']
+        self.job = None
+        self.work = None
+        _poller.add(self, continuation.get('notify'))
+    
+    def _unpack_pending(self):
+        return self._resultpackage is not None
+    
+    def _unpack_result(self):
+        with self._condition:
+            package = self._resultpackage
+            if package is None:
+                return
+            self._resultpackage = None
+            try:
+                result = utils.unpack(package)
+                if 'spool' in result:
+                    path = result['spool']
+                    result = spool.load(path)
+                    # Work which depends on us may still need to read it, even
+                    # after we are collected; it is left to the sweep. The memo
+                    # may still need to store it; it is removed once we are.
+                    if not (self._referenced or self._memoize):
+                        spool.remove(path)
+            except Exception as e:
+                self._exception = e
+                return
+            self._profile = result.get('profile')
+            # Which calls of a chunk failed; see ChunkFuture.
+            if 'failed' in result:
+                self._failed = frozenset(result['failed'])
+            if 'result' in result:
+                self._result = result['result']
+            elif 'exception' in result:
+                self._exception = result['exception']
+            else:
+                self._exception = RuntimeError('invalid resultpackage')
+    
+    def _pop_memo_package(self):
+        # Called from the memo store's thread; see Executor._memo_remember.
+        package, self._memo_package = self._memo_package, None
+        if package is None or 'exception' in package or package.get('status') != 'complete':
+            return None
+        if 'spool' in package:
+            # Stored whole, since the spooled file will not be kept.
+            with open(package['spool'], 'rb') as fh:
+                package = {'status': 'complete', '__pickle__': fh.read().encode('base64')}
+        return package
+    
+    def result(self, timeout=None):
+        # Wait for it to finish (or raise) before unpacking.
+        super(Future, self).exception(timeout)
+        self._unpack_result()
+        return super(Future, self).result(0)
+    
+    def exception(self, timeout=None):
+        super(Future, self).exception(timeout)
+        self._unpack_result()
+        return super(Future, self).exception(0)
+    
+    def exception_info(self, timeout=None):
+        super(Future, self).exception_info(timeout)
+        self._unpack_result()
+        return super(Future, self).exception_info(0)
+    
+    def profile(self, timeout=None):
+        """Get the profile of the work item, if it was submitted with
+        ``profile=True``.
+        
+        :returns: A :class:`pstats.Stats`, or ``None``.
+        
+        """
+        self.exception(timeout)
+        if self._profile is not None:
+            return pstats.Stats(_ProfileStats(self._profile))
+    
+    def cancel(self):
+        """Cancel the future, killing the work on Qube if it is not finished.
+        
+        :returns: ``False`` if the future had already finished.
+        
+        """
+        return not cancel([self])
+    
+    def status(self, refresh=False):
+        """Get the status for this particular work item.
+        
+        This is answered from the last poll of the job, unless there hasn't been
+        one yet or ``refresh`` is set. See :func:`qbfutures.statuses`.
+        
+        """
+        return statuses([self], refresh)[0]
+    
+    def _set_snapshot(self, job, work):
+        self.job = job
+        self.work = work
+
+
+class _ProfileStats(object):
+    
+    # Looks enough like a cProfile.Profile for pstats.Stats to load.
+    
+    def __init__(self, stats):
+        self.stats = stats
+    
+    def create_stats(self):
+        pass
+
+
+def statuses(futures, refresh=False):
+    """Get the statuses of many work items at once.
+    
+    Statuses are answered from the last poll of each job where possible. Any
+    that are missing, or all of them if ``refresh`` is set, are fetched with a
+    single query to the supervisor; every future's ``job`` and ``work``
+    snapshots are updated along the way.
+    
+    :returns: A list of statuses, in the same order as the futures; ``None``
+        for futures which have not been submitted yet.
+    
+    """
+    
+    futures = list(futures)
+    
+    # Only submitted futures can be asked about.
+    stale = {}
+    for future in futures:
+        if future.job_id and (refresh or future.job is None):
+            stale.setdefault(future.job_id, []).append(future)
+    
+    if stale:
+        for job in qb.jobinfo(id=sorted(stale), agenda=True):
+            # Don't hold on to every result in the job; see Poller._update_snapshot.
+            snapshot = dict((k, v) for k, v in job.iteritems() if k != 'agenda')
+            for future in stale.get(job['id'], ()):
+                future._set_snapshot(snapshot, job['agenda'][future.work_id])
+    
+    return [future.work['status'] if future.job_id and future.job is not None else None for future in futures]
+
+
+def _cancel_locally(future):
+    # Our futures are never marked as running, so this always works. Waiters
+    # (e.g. in concurrent.futures.wait) are only woken once notified.
+    _base.Future.cancel(future)
+    future.set_running_or_notify_cancel()
+
+
+def cancel(futures):
+    """Cancel the given futures, killing their work on Qube.
+    
+    Unlike cancelling futures individually, this makes only one call to the
+    supervisor for each job. Calls within a chunk are only killed on Qube once
+    every call in that chunk has been cancelled.
+    
+    :returns: The list of futures which could not be cancelled since they had
+        already finished.
+    
+    """
+    
+    finished = []
+    to_kill = {}
+    
+    for future in futures:
+        
+        if future.done():
+            if not future.cancelled():
+                finished.append(future)
+            continue
+        
+        _cancel_locally(future)
+        
+        owner = future
+        if isinstance(future, ChunkedFuture):
+            owner = future.chunk
+            if not owner._elements_done():
+                continue
+            _cancel_locally(owner)
+        
+        # Batches which have not been committed yet have nothing to kill.
+        if owner.job_id:
+            to_kill.setdefault(owner.job_id, set()).add(owner.work_id)
+        
+        # Nor should the duplicate of straggling work carry on.
+        duplicate = owner._hedge.duplicate if owner._hedge is not None else None
+        if duplicate is not None and not duplicate.done():
+            _cancel_locally(duplicate)
+            if duplicate.job_id:
+                to_kill.setdefault(duplicate.job_id, set()).add(duplicate.work_id)
+    
+    for job_id, work_ids in sorted(to_kill.iteritems()):
+        qb.killwork(['%d:%d' % (job_id, work_id) for work_id in sorted(work_ids)])
+    
+    return finished
+
+
+# What a follow-up call inherits from the job, and the work package, of the
+# call which returned the continuation.
+_CONTINUATION_JOB_KEYS = ('cluster', 'env', 'groups', 'priority', 'requirements', 'reservations', 'restrictions', 'user')
+_CONTINUATION_PACKAGE_KEYS = (
+    'interpreter', 'preflight', 'filename', 'workspace', 'version',
+    'reuse_child', 'fork_server', 'spool_dir', 'spool_threshold', 'profile',
+)
+
+
+def _submit_continuation(job, package, continuation):
+    """Submit the follow-up call of a :class:`~qbfutures.Continuation`.
+    
+    Called on the farm with the job and (unpacked) work package of the call
+    which returned it.
+    
+    :returns: Where the client can find the follow-up call.
+    
+    """
+    
+    extra = dict(continuation.extra)
+    for key in _CONTINUATION_JOB_KEYS:
+        if key in job and key not in extra:
+            extra[key] = job[key]
+    
+    # The client's notification address is already in the inherited env.
+    extra['notify'] = False
+    
+    executor = Executor()
+    follow_job = executor._base_job(continuation.func, **extra)
+    follow_package = executor._base_work_package(continuation.func, continuation.args, continuation.kwargs, extra)
+    for key in _CONTINUATION_PACKAGE_KEYS:
+        if key in package and key not in extra:
+            follow_package[key] = package[key]
+    
+    # The follow-up is at the same depth as us, not below us.
+    follow_job['env']['QBLVL'] = os.environ.get('QBLVL', follow_job['env']['QBLVL'])
+    
+    # We don't care when it finishes, but the client does.
+    future = Future(0, 0)
+    executor._submit_jobs([(executor._single_job(follow_job, follow_package), [future])], watch=False)
+    
+    # Any futures the call submitted are now for the follow-up call to wait
+    # on, so don't leave them (and the poller) running in a reused child.
+    _reset_poller()
+    
+    return {
+        'job_id': future.job_id,
+        'work_id': future.work_id,
+        'notify': 'QBFUTURES_NOTIFY_ADDRESS' in follow_job['env'],
+    }
 
 
 class BatchFuture(Future):
     
     def __init__(self, work):
         super(BatchFuture, self).__init__(0, 0)
+        
+        # The work item to submit; replaced by snapshots once submitted.
         self.work = work
 
 
+class ChunkFuture(Future):
+    
+    """A Future for a work item which executes a chunk of calls.
+    
+    This is not exposed to users; it fans out to a :class:`ChunkedFuture` for
+    every call within the chunk.
+    
+    """
+    
+    def __init__(self, work=None):
+        super(ChunkFuture, self).__init__(0, 0)
+        self.work = work
+        self._elements = []
+        self._failed = frozenset()
+        self._add_inline_callback(ChunkFuture._fan_out)
+    
+    def element(self, index):
+        """Get a new future for the call at the given index within the chunk."""
+        element = ChunkedFuture(self, index)
+        self._elements.append(weakref.ref(element))
+        return element
+    
+    def _elements_done(self):
+        for ref in self._elements:
+            element = ref()
+            if element is not None and not element.done():
+                return False
+        return True
+    
+    def _fan_out(self):
+        
+        # Which calls failed is usually available without unpacking the
+        # results, unless the whole chunk failed. The elements check again
+        # once they are unpacked.
+        package = self._resultpackage
+        if package is None or package.get('status') != 'complete':
+            failed = None
+        else:
+            failed = self._failed = frozenset(package.get('failed') or ())
+        
+        for ref in self._elements:
+            element = ref()
+            if element is None or element.done():
+                continue
+            if self.cancelled():
+                _cancel_locally(element)
+                continue
+            element._chunk_pending = True
+            if failed is None or element.index in failed:
+                element.set_exception(None)
+            else:
+                element.set_result(None)
+
+
+class ChunkedFuture(Future):
+    
+    """A Future representing one call within a chunk of calls on Qube."""
+    
+    def __init__(self, chunk, index):
+        _base.Future.__init__(self)
+        self._inline_callbacks = []
+        self._resultpackage = None
+        self._chunk_pending = False
+        self.chunk = chunk
+        self.index = index
+    
+    @property
+    def job_id(self):
+        return self.chunk.job_id
+    
+    @property
+    def work_id(self):
+        return self.chunk.work_id
+    
+    @property
+    def job(self):
+        return self.chunk.job
+    
+    @property
+    def timings(self):
+        return self.chunk.timings
+    
+    def profile(self, timeout=None):
+        """Get the profile of the whole chunk this call was part of."""
+        self.exception(timeout)
+        return self.chunk.profile(0)
+    
+    @property
+    def work(self):
+        return self.chunk.work
+    
+    def _set_snapshot(self, job, work):
+        self.chunk._set_snapshot(job, work)
+    
+    def _unpack_pending(self):
+        return self._chunk_pending
+    
+    def _unpack_result(self):
+        with self._condition:
+            if not self._chunk_pending:
+                return
+            self._chunk_pending = False
+            try:
+                result = self.chunk.result(0)[self.index]
+            except Exception as e:
+                self._exception = e
+                return
+            # Unpacking the chunk has read its failed calls.
+            if self.index in self.chunk._failed:
+                self._exception = result
+            else:
+                self._result = result
+    
+    def _pop_memo_package(self):
+        # Our call's share of the chunk is only known once it is unpacked.
+        if self.cancelled() or self.exception(0) is not None:
+            return None
+        return utils.pack({'status': 'complete', 'result': self.result(0)})
+
+
+class _FollowingFuture(Future):
+    
+    """A Future which finishes the same way as another, e.g. for a repeated
+    call within a memoized map.
+    
+    The result is only taken from the other future when it is asked for, so
+    that it is not unpacked by the poller.
+    
+    """
+    
+    def __init__(self, source):
+        super(_FollowingFuture, self).__init__(0, 0)
+        self._follows = source
+        self._source_pending = False
+        # Inline, since the dispatcher may only be run by a thread which is
+        # itself waiting on us.
+        source._add_inline_callback(self._source_done)
+    
+    def _source_done(self, source):
+        if self.done():
+            return
+        if source.cancelled():
+            _cancel_locally(self)
+        else:
+            self._source_pending = True
+            self.set_result(None)
+    
+    def _unpack_pending(self):
+        return self._source_pending
+    
+    def _unpack_result(self):
+        with self._condition:
+            if not self._source_pending:
+                return
+            self._source_pending = False
+            exception = self._follows.exception(0)
+            if exception is not None:
+                self._exception = exception
+            else:
+                self._result = self._follows.result(0)
+
+
 class Batch(object):
     
     """Pseudo-executor that submits callables into a single Qube job.
@@ -69,10 +600,20 @@ class Batch(object):
     
     """
     
-    def __init__(self, executor, job):
+    def __init__(self, executor, job, deferred=False, hedge=None):
         self.executor = executor
         self.job = job
         self.futures = []
+        
+        # Batches within a MultiBatch are submitted by it instead.
+        self._deferred = deferred
+        
+        # ``(remaining, factor)`` to duplicate stragglers; see Executor.map.
+        self._hedge_options = hedge
+        
+        # The futures which own a work item, in agenda order. Usually the
+        # same as above, except for chunked maps.
+        self.work_futures = []
 
     @property
     def job_id(self):
@@ -91,8 +632,15 @@ class Batch(object):
         work['name'] = extra.get('name',
             '%d: %s' % (len(self.futures) + 1, utils.get_func_name(func))
         )
-        work['package'] = utils.pack(self.executor._base_work_package(func, args, kwargs, extra))
-        future = BatchFuture(work)
+        package = self.executor._base_work_package(func, args, kwargs, extra)
+        
+        def submit():
+            work['package'] = utils.pack(package)
+            future = BatchFuture(work)
+            self.work_futures.append(future)
+            return future
+        
+        future = self.executor._memoized(package, submit)
         self.futures.append(future)
         return future
     
@@ -101,20 +649,44 @@ class Batch(object):
         except extra keyword arguments are passed to the ``qb.Work``.
         
         """
-        futures = []
-        for i, args in enumerate(zip(*iterables)):
-            
-            work = qb.Work()
-            package = self.executor._base_work_package(func, args, None, extra)
-            work['name'] = package.pop('name', str(i + 1))
-            work['package'] = utils.pack(package)
-            
-            future = BatchFuture(work)
-            futures.append(future)
-            self.futures.append(future)
-        
+        futures = self._map(func, iterables, extra)
         return self.executor._map_iter(futures, extra.get('timeout'))
     
+    def imap(self, func, *iterables, **extra):
+        """Same as :meth:`map`, for parity with :meth:`Executor.imap
+        <qbfutures.Executor.imap>`.
+        
+        Every call is submitted along with the batch, so there is nothing to
+        hold back while waiting on a slow one; results which finish out of
+        order simply wait in their futures. ``reorder_buffer`` is accepted,
+        but has no effect.
+        
+        """
+        extra.pop('reorder_buffer', None)
+        return self.map(func, *iterables, **extra)
+    
+    def imap_unordered(self, func, *iterables, **extra):
+        """Same as :meth:`map`, except results are returned as soon as they
+        finish, instead of in order.
+        
+        """
+        futures = self._map(func, iterables, extra)
+        return self.executor._as_completed_iter(futures, extra.get('timeout'))
+    
+    def _map(self, func, iterables, extra):
+        shared_key = 'map%d' % (len(self.job['package']) + 1)
+        shared_package = self.executor._base_work_package(func, None, None, extra)
+        
+        def submit(arg_tuples):
+            works, work_futures, futures = self.executor._map_futures(
+                self.job, shared_key, shared_package, arg_tuples, BatchFuture, extra.get('chunksize'))
+            self.work_futures.extend(work_futures)
+            return futures
+        
+        futures = self.executor._memoized_map(shared_package, zip(*iterables), submit)
+        self.futures.extend(futures)
+        return futures
+    
     def __enter__(self):
         return self
     
@@ -125,19 +697,403 @@ class Batch(object):
     def commit(self):
         """Perform the actual job submittion. Called automatically if used as
         a context manager."""
-        if not self.futures:
-            return []
-        self.job['agenda'] = [future.work for future in self.futures]
-        submitted = qb.submit([self.job])
-        assert len(submitted) == 1
-        for i, future in enumerate(self.futures):
-            future.job_id = submitted[0]['id']
-            future.work_id = i
-            _poller.add(future)
-        _poller.trigger()
+        if not self.futures or self._deferred:
+            return self.futures
+        self.executor._submit_jobs([self._prepare()])
+        self._start_hedging()
+        return self.futures
+    
+    def _prepare(self):
+        # Don't bother submitting what has already been cancelled.
+        self.work_futures = [future for future in self.work_futures if not future.cancelled()]
+        self.job['agenda'] = [future.work for future in self.work_futures]
+        return self.job, self.work_futures
+    
+    def _start_hedging(self):
+        if self._hedge_options and self.work_futures:
+            _Hedger(self.executor, self.job, self.work_futures, *self._hedge_options).start()
+
+
+class MultiBatch(object):
+    
+    """Pseudo-executor that gathers many jobs to submit to Qube at once.
+    
+    Every call to :meth:`submit` or :meth:`map` is its own job, and so may have
+    its own job options. As with :class:`Batch`, the resulting futures are not
+    usable until the jobs are submitted, either by using the ``MultiBatch`` as a
+    context manager, or calling :meth:`commit`.
+    
+    """
+    
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = []
+        
+        # (job, work_futures) pairs, or batches, in order of submission.
+        self._jobs = []
+        
+        # (job, work_futures, hedge) for maps which duplicate stragglers.
+        self._hedges = []
+    
+    def submit(self, func, *args, **kwargs):
+        """Same as :func:`Executor.submit <qbfutures.Executor.submit>`"""
+        return self.submit_ext(func, args, kwargs)
+    
+    def submit_ext(self, func, args=None, kwargs=None, **extra):
+        """Same as :meth:`Executor.submit_ext <qbfutures.Executor.submit_ext>`"""
+        job = self.executor._base_job(func, **extra)
+        package = self.executor._base_work_package(func, args, kwargs, extra)
+        
+        def submit():
+            future = Future(0, 0)
+            self._jobs.append((self.executor._single_job(job, package), [future]))
+            return future
+        
+        future = self.executor._memoized(package, submit)
+        self.futures.append(future)
+        return future
+    
+    def map(self, func, *iterables, **extra):
+        """Like :meth:`Executor.map <qbfutures.Executor.map>`, except it
+        returns the list of futures for every call.
+        
+        """
+        chunksize = extra.pop('chunksize', None)
+        hedge = self.executor._pop_hedge(extra)
+        job, work_futures, futures = self.executor._map_job(func, zip(*iterables), extra, chunksize)
+        self._jobs.append((job, work_futures))
+        if hedge and work_futures:
+            self._hedges.append((job, work_futures, hedge))
+        self.futures.extend(futures)
+        return futures
+    
+    def batch(self, name=None, **kwargs):
+        """Same as :meth:`Executor.batch <qbfutures.Executor.batch>`, except
+        the batch is submitted along with everything else.
+        
+        """
+        batch = self.executor.batch(name, **kwargs)
+        batch._deferred = True
+        self._jobs.append(batch)
+        return batch
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        if not exc_info[0]:
+            self.commit()
+    
+    def commit(self):
+        """Submit all of the jobs. Called automatically if used as a context
+        manager."""
+        
+        jobs = []
+        batches = []
+        for job in self._jobs:
+            if isinstance(job, Batch):
+                if not job.futures:
+                    continue
+                self.futures.extend(job.futures)
+                batches.append(job)
+                job = job._prepare()
+            else:
+                # Don't bother submitting what has already been cancelled. The
+                # futures are filtered in place, since hedging shares them.
+                job, work_futures = job
+                live = [(work, future) for work, future in zip(job['agenda'], work_futures) if not future.cancelled()]
+                job['agenda'] = [work for work, future in live]
+                work_futures[:] = [future for work, future in live]
+                job = (job, work_futures)
+            jobs.append(job)
+        self._jobs = []
+        
+        if jobs:
+            self.executor._submit_jobs(jobs)
+        for batch in batches:
+            batch._start_hedging()
+        for job, work_futures, hedge in self._hedges:
+            if work_futures:
+                _Hedger(self.executor, job, work_futures, *hedge).start()
+        self._hedges = []
         return self.futures
 
 
+class _Coalescer(object):
+    
+    """Groups work submitted within a short window into as few jobs as we can.
+    
+    Work is grouped with other work that would have been submitted with the
+    same job options. Futures are returned immediately, and are bound once
+    their job has been submitted in the background.
+    
+    """
+    
+    def __init__(self, executor, window):
+        self.executor = executor
+        self.window = window
+        self.condition = threading.Condition()
+        self.groups = collections.OrderedDict()
+        self.deadline = None
+        self.thread = None
+    
+    @staticmethod
+    def _job_key(job):
+        items = []
+        for key, value in sorted(job.iteritems()):
+            if key in ('name', 'agenda', 'package'):
+                continue
+            if isinstance(value, dict):
+                value = sorted(value.iteritems())
+            items.append((key, value))
+        return repr(items)
+    
+    def add(self, job, work, package):
+        
+        future = Future(0, 0)
+        key = self._job_key(job)
+        
+        with self.condition:
+            
+            group = self.groups.get(key)
+            if group is None:
+                job['agenda'] = []
+                group = self.groups[key] = (job, [])
+            job, futures = group
+            
+            work['name'] = str(package.pop('name', len(futures) + 1))
+            work['package'] = utils.pack(package)
+            job['agenda'].append(work)
+            futures.append(future)
+            
+            if self.deadline is None:
+                self.deadline = time.time() + self.window
+                self.condition.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='qbfutures-coalescer')
+                self.thread.daemon = True
+                self.thread.start()
+        
+        return future
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.deadline is None:
+                    self.condition.wait()
+                while time.time() < self.deadline:
+                    self.condition.wait(self.deadline - time.time())
+            self.flush()
+    
+    def flush(self):
+        """Submit everything which is waiting."""
+        
+        with self.condition:
+            groups = self.groups.values()
+            self.groups = collections.OrderedDict()
+            self.deadline = None
+        
+        jobs = []
+        for job, futures in groups:
+            
+            # Don't bother submitting what has already been cancelled.
+            live = [(work, future) for work, future in zip(job['agenda'], futures) if not future.cancelled()]
+            if live:
+                job['agenda'] = [work for work, future in live]
+                jobs.append((job, [future for work, future in live]))
+        
+        if not jobs:
+            return
+        try:
+            self.executor._submit_jobs(jobs)
+        except Exception as e:
+            for job, futures in jobs:
+                for future in futures:
+                    if not future.job_id:
+                        future.set_exception(e)
+
+
+class _Hedge(object):
+    
+    """The attempts at one work item: the original, and a duplicate.
+    
+    The first attempt to succeed (or the last to fail) finishes the original
+    future, and the other is killed.
+    
+    """
+    
+    def __init__(self, original):
+        self.original = original
+        self.duplicate = None
+        self.lock = threading.Lock()
+        self.reported = set()
+        self.failure = None
+        self.settled = False
+    
+    def settle(self, attempt, package):
+        
+        with self.lock:
+            
+            # The original may have finished (or been cancelled) before it
+            # was duplicated, or since.
+            if self.settled or self.original.done():
+                self.settled = True
+                return
+            self.reported.add(attempt)
+            
+            # Give the other attempt a chance to succeed.
+            other = self.duplicate if attempt is self.original else self.original
+            if 'exception' in package or package.get('status') != 'complete':
+                if other is not None and other not in self.reported:
+                    self.failure = self.failure or package
+                    return
+                package = self.failure or package
+            
+            self.settled = True
+            loser = other if other is not None and other not in self.reported else None
+        
+        if attempt is self.duplicate and package is not self.failure:
+            _hedge_wins.inc()
+        
+        self.original._set_resultpackage(package)
+        if attempt is self.duplicate:
+            attempt._set_resultpackage(package)
+        
+        if loser is not None:
+            if loser is self.duplicate:
+                _cancel_locally(loser)
+            if loser.job_id:
+                qb.killwork(['%d:%d' % (loser.job_id, loser.work_id)])
+    
+    def abandon(self):
+        """The duplicate could not be submitted."""
+        with self.lock:
+            self.duplicate = None
+            failure = self.failure if not self.settled and self.original in self.reported else None
+            self.settled = self.settled or failure is not None
+        if failure is not None:
+            self.original._set_resultpackage(failure)
+
+
+class _Hedger(object):
+    
+    """Duplicates the slowest work items at the tail of a job.
+    
+    Once no more than ``remaining`` of the work items are outstanding, any
+    which have been running for ``factor`` times longer than the median of
+    those which finished are submitted again in a new job, avoiding the hosts
+    they are running on where we know them.
+    
+    """
+    
+    interval = 1.0
+    
+    def __init__(self, executor, job, futures, remaining, factor):
+        self.executor = executor
+        self.job = job
+        self.futures = list(futures)
+        self.remaining = remaining
+        self.factor = factor
+        self.submitted_at = time.time()
+        self.durations = []
+        self.condition = threading.Condition()
+        for future in self.futures:
+            future._add_inline_callback(self._finished)
+    
+    def start(self):
+        thread = threading.Thread(target=self._run, name='qbfutures-hedger')
+        thread.daemon = True
+        thread.start()
+    
+    def _finished(self, future):
+        work = future.work or {}
+        if work.get('timestart') and work.get('timecomplete'):
+            duration = work['timecomplete'] - work['timestart']
+        else:
+            duration = time.time() - self.submitted_at
+        with self.condition:
+            self.durations.append(duration)
+            self.condition.notify()
+    
+    def _running_for(self, future, now):
+        work = future.work
+        if work is None:
+            return now - self.submitted_at
+        if work.get('status') != 'running' or not work.get('timestart'):
+            return None
+        return now - work['timestart']
+    
+    def _run(self):
+        while True:
+            
+            with self.condition:
+                self.condition.wait(self.interval)
+                durations = sorted(self.durations)
+            
+            outstanding = [f for f in self.futures if not f.done()]
+            if not outstanding or self.executor._shutdown:
+                return
+            if not durations or len(outstanding) > self.remaining * len(self.futures):
+                continue
+            
+            now = time.time()
+            limit = self.factor * durations[len(durations) // 2]
+            stragglers = []
+            for future in outstanding:
+                running_for = self._running_for(future, now)
+                if future._hedge is None and running_for is not None and running_for > limit:
+                    stragglers.append(future)
+            
+            if stragglers:
+                self._duplicate(stragglers)
+    
+    def _duplicate(self, stragglers):
+        
+        job = dict((k, v) for k, v in self.job.iteritems() if k not in ('id', 'agenda', 'dependency'))
+        job['name'] = '%s (hedge)' % self.job['name']
+        job['agenda'] = []
+        
+        # Stay away from the hosts which are struggling.
+        hosts = sorted(set((f.work or {}).get('host') for f in stragglers) - set([None, '']))
+        if hosts:
+            requirements = [job['requirements']] if job.get('requirements') else []
+            requirements.extend('host.name!=%s' % host for host in hosts)
+            job['requirements'] = ' and '.join(requirements)
+        
+        hedges = []
+        duplicates = []
+        for future in stragglers:
+            original_work = self.job['agenda'][self.futures.index(future)]
+            work = qb.Work()
+            work['name'] = original_work['name']
+            work['package'] = original_work['package']
+            job['agenda'].append(work)
+            
+            hedge = future._hedge = _Hedge(future)
+            hedge.duplicate = duplicate = Future(0, 0)
+            duplicate._hedge = hedge
+            hedges.append(hedge)
+            duplicates.append(duplicate)
+        
+        try:
+            self.executor._submit_jobs([(job, duplicates)])
+        except Exception:
+            _base.LOGGER.exception('could not duplicate straggling work')
+            for hedge in hedges:
+                hedge.abandon()
+            return
+        
+        _hedged_work.inc(len(duplicates))
+        
+        # Some may have finished while we were submitting.
+        for hedge in hedges:
+            with hedge.lock:
+                settled = hedge.settled or hedge.original.done()
+            if settled and not hedge.duplicate.done():
+                _cancel_locally(hedge.duplicate)
+                qb.killwork(['%d:%d' % (hedge.duplicate.job_id, hedge.duplicate.work_id)])
+
+
 class Executor(_base.Executor):
     
     """An object which provides methods to execute functions asynchonously on Qube.
@@ -145,14 +1101,50 @@ class Executor(_base.Executor):
     Any keyword arguments passed to the constructor are used as a template for
     every job submitted to Qube.
     
+    :param float coalesce: Group calls to :meth:`submit` made within this many
+        seconds of each other (from any thread) into a single job, instead of
+        submitting one job per call. The returned futures are bound to their
+        work once the job has been submitted in the background.
+    :param memoize: Answer calls from a shared store of results where
+        possible, and store the results of those which succeed; either
+        ``True`` for ``QBFUTURES_MEMO_DIR``, a directory, or a
+        :class:`qbfutures.memo.Store`. See :mod:`qbfutures.memo`.
+    
     """
     
     environ_passthroughs = ['VEE_EXEC_ARGS', 'KS_DEV_ARGS']
     
-    def __init__(self, **kwargs):
+    def __init__(self, coalesce=None, memoize=None, **kwargs):
         super(Executor, self).__init__()
         self.defaults = kwargs
         
+        # Every future with a work item on Qube, so that we can cancel them.
+        self._futures = weakref.WeakSet()
+        self._shutdown = False
+        
+        # Group submits within this many seconds of each other into one job.
+        self._coalescer = _Coalescer(self, coalesce) if coalesce else None
+        
+        # Where results are remembered between calls.
+        self._memo = memo.get_store(memoize) if memoize else None
+    
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Signal the executor that no more jobs will be submitted.
+        
+        :param bool wait: Wait for all outstanding futures to finish.
+        :param bool cancel_pending: Cancel all outstanding futures, killing
+            their work on Qube.
+        
+        """
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        self._shutdown = True
+        futures = [f for f in self._futures if not f.done()]
+        if cancel_pending:
+            cancel(futures)
+        if wait:
+            wait_for(futures)
+        
     def _base_job(self, func, **kwargs):
         
         job = dict(self.defaults)
@@ -169,7 +1161,11 @@ class Executor(_base.Executor):
         job['env']['QBFUTURES_DIR'] = os.path.abspath(os.path.join(__file__, '..', '..'))
         
         # Passthrough select environment variables.
-        for name in itertools.chain(self.environ_passthroughs, ('QBFUTURES_RECURSION_LIMIT', )):
+        for name in itertools.chain(self.environ_passthroughs, (
+            'QBFUTURES_RECURSION_LIMIT', 'QBFUTURES_SPOOL_DIR', 'QBFUTURES_SPOOL_THRESHOLD', 'QBFUTURES_SPOOL_MAX_AGE',
+            'QBFUTURES_SERIALIZER', 'QBFUTURES_PICKLE_PROTOCOL',
+            'QBFUTURES_COMPRESSION', 'QBFUTURES_COMPRESSION_THRESHOLD',
+        )):
             if name in os.environ:
                 job['env'][name] = os.environ[name]
         
@@ -180,6 +1176,10 @@ class Executor(_base.Executor):
             raise RuntimeError('Qube recursion reached limit of %s' % limit)
         job['env']['QBLVL'] = str(depth + 1)
         
+        # Have the workers tell us when they finish.
+        if job.pop('notify', os.environ.get('QBFUTURES_NOTIFY')):
+            job['env']['QBFUTURES_NOTIFY_ADDRESS'] = _poller.listen()
+        
         job['agenda'] = []
         job['package'] = {}
         
@@ -187,14 +1187,18 @@ class Executor(_base.Executor):
     
     def _base_work_package(self, func, args=None, kwargs=None, extra=None):
         
+        # Futures in the arguments become dependencies on their work.
+        depends = set()
         package = {
             'func': func,
-            'args': args or (),
-            'kwargs': dict(kwargs or {}),
+            'args': self._reference_futures(args or (), depends),
+            'kwargs': self._reference_futures(dict(kwargs or {}), depends),
         }
+        if depends:
+            package['depends'] = sorted(depends)
         
         extra = extra or {}
-        for attr in ('interpreter', 'name'):
+        for attr in ('interpreter', 'name', 'reuse_child', 'fork_server', 'spool_dir', 'spool_threshold', 'profile'):
             if attr in self.defaults:
                 package[attr] = self.defaults[attr]
             if attr in extra:
@@ -202,31 +1206,223 @@ class Executor(_base.Executor):
         
         return package
     
-    def _submit(self, job):
+    def _reference_futures(self, obj, depends):
+        """Replace futures within arguments (including within lists, tuples,
+        and dicts) with references to their work on Qube.
+        
+        Futures which have already succeeded are replaced by their result.
+        
+        :param set depends: The ``"job_id:work_id"`` of every work item which
+            is referenced is added to this.
+        
+        """
+        
+        if isinstance(obj, Future):
+            return self._reference_future(obj, depends)
+        
+        if type(obj) in (list, tuple):
+            items = [self._reference_futures(x, depends) for x in obj]
+            changed = any(new is not old for new, old in zip(items, obj))
+        elif type(obj) is dict:
+            items = [(k, self._reference_futures(v, depends)) for k, v in obj.iteritems()]
+            changed = any(new is not obj[k] for k, new in items)
+        else:
+            return obj
+        
+        # Don't copy arguments which have no futures within them.
+        return type(obj)(items) if changed else obj
+    
+    def _reference_future(self, future, depends):
+        
+        # Repeated calls within a memoized map depend on the original.
+        while getattr(future, '_follows', None) is not None:
+            future = future._follows
+        
+        # Coalesced work isn't bound until it is submitted.
+        if not future.job_id and not future.done() and self._coalescer is not None:
+            self._coalescer.flush()
+        
+        if future.done() and not future.cancelled():
+            if future.exception() is None:
+                return future.result()
+            if not future.job_id:
+                raise future.exception()
+        
+        if not future.job_id:
+            if future.cancelled():
+                raise _base.CancelledError()
+            raise ValueError('cannot depend on %r before it is submitted' % future)
+        
+        owner = future.chunk if isinstance(future, ChunkedFuture) else future
+        owner._referenced = True
+        spool.release(owner)
+        ref = utils.FutureRef(future.job_id, future.work_id, getattr(future, 'index', None))
+        depends.add(ref.key)
+        return ref
+    
+    #: How many jobs to submit to Qube at once.
+    max_jobs_per_submit = 100
+    
+    def _submit(self, job, futures=None):
+        # Bind the given futures, or create new ones.
+        futures = futures or [Future(0, 0) for work in job['agenda']]
+        self._submit_jobs([(job, futures)])
+        return futures
+    
+    def _submit_jobs(self, jobs, watch=True):
+        """Submit many jobs with as few calls to Qube as possible.
+        
+        :param list jobs: ``(job, futures)`` pairs, with a future for every
+            work item in the job's agenda.
+        :param bool watch: Poll for the futures; otherwise they are only bound.
+        
+        """
+        
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        
+        # Everything in some jobs may have been answered by the memo store.
+        jobs = [(job, futures) for job, futures in jobs if job['agenda']]
+        
+        for job, futures in jobs:
+            
+            # Final chance for cleanup! Qube does not like None names.
+            try:
+                if job['user'] is None:
+                    job.pop('user')
+            except KeyError:
+                pass
+            
+            # Assign a default user from the environment.
+            try:
+                job.setdefault('user', os.environ['QBFUTURES_USER'])
+            except KeyError:
+                pass
+            
+            # Wait for the jobs of any futures passed as arguments. Work only
+            # depends on like-named work in Qube, so we must wait for the
+            # whole job, whether it succeeds or not.
+            depends = set()
+            for package in itertools.chain(job['package'].itervalues(), (work['package'] for work in job['agenda'])):
+                depends.update(package.get('depends') or ())
+            if depends:
+                links = ['link-done-job-%d' % job_id for job_id in sorted(set(int(key.split(':')[0]) for key in depends))]
+                if job.get('dependency'):
+                    links.insert(0, job['dependency'])
+                job['dependency'] = ','.join(links)
         
-        # Final chance for cleanup! Qube does not like None names.
-        try:
-            if job['user'] is None:
-                job.pop('user')
-        except KeyError:
-            pass
-
-        # Assign a default user from the environment.
         try:
-            job.setdefault('user', os.environ['QBFUTURES_USER'])
-        except KeyError:
-            pass
-
-        job_id = qb.submit([job])[0]['id']
+            for start in xrange(0, len(jobs), self.max_jobs_per_submit):
+                
+                chunk = jobs[start:start + self.max_jobs_per_submit]
+                submitted = _qb_submit([job for job, futures in chunk])
+                assert len(submitted) == len(chunk)
+                
+                for (job, futures), info in zip(chunk, submitted):
+                    notifying = 'QBFUTURES_NOTIFY_ADDRESS' in job['env']
+                    for work_id, future in enumerate(futures):
+                        future.job_id = info['id']
+                        future.work_id = work_id
+                        if watch:
+                            self._futures.add(future)
+                            _poller.add(future, notifying)
         
-        futures = []
-        for work_id, work in enumerate(job['agenda']):
-            future = Future(job_id, work_id)
-            futures.append(future)
-            _poller.add(future)
+        # Even if we failed part way through, watch what we did submit.
+        finally:
+            if watch:
+                _poller.trigger()
+    
+    def _single_job(self, job, package):
+        """Fill in the agenda of a job to make a single call."""
+        package = dict(package)
+        work = qb.Work()
+        work['name'] = str(package.pop('name', '1'))
+        work['package'] = utils.pack(package)
+        job['agenda'] = [work]
+        return job
+    
+    def _memoized(self, package, submit):
+        """Answer a call from the memo store, or call ``submit()`` for its
+        future and store the result once it succeeds.
+        
+        """
+        
+        key = memo.make_key(package) if self._memo is not None else None
+        if key is None:
+            return submit()
         
-        _poller.trigger()
+        found, package = self._memo.get(key)
+        if found:
+            future = Future(0, 0)
+            future._set_resultpackage(package)
+            return future
+        
+        future = submit()
+        self._memo_remember(key, future)
+        return future
+    
+    def _memoized_map(self, package, arg_tuples, submit):
+        """Like :meth:`_memoized`, for many calls to the same function.
+        
+        Only the calls which are neither in the memo store nor repeats of an
+        earlier one are passed to ``submit(arg_tuples)``, which returns a future
+        for each.
+        
+        :returns: The list of futures, one for every call.
+        
+        """
+        
+        if self._memo is None:
+            return submit(arg_tuples)
+        
+        # Each call is either a finished future, or an index into the calls
+        # to submit.
+        calls = []
+        to_submit = []
+        keys = []
+        indices = {}
+        for args in arg_tuples:
+            key = memo.make_key(dict(package, args=args))
+            if key in indices:
+                memo._duplicates.inc()
+                calls.append(indices[key])
+                continue
+            if key is not None:
+                found, stored = self._memo.get(key)
+                if found:
+                    future = Future(0, 0)
+                    future._set_resultpackage(stored)
+                    calls.append(future)
+                    continue
+                indices[key] = len(to_submit)
+            calls.append(len(to_submit))
+            to_submit.append(args)
+            keys.append(key)
+        
+        submitted = submit(to_submit) if to_submit else []
+        for key, future in zip(keys, submitted):
+            if key is not None:
+                self._memo_remember(key, future)
+        
+        # Repeated calls follow the first.
+        futures = []
+        seen = set()
+        for call in calls:
+            if not isinstance(call, int):
+                futures.append(call)
+            elif call in seen:
+                futures.append(_FollowingFuture(submitted[call]))
+            else:
+                seen.add(call)
+                futures.append(submitted[call])
         return futures
+    
+    def _memo_remember(self, key, future):
+        # The poller only queues the future; its packed result is stored by the
+        # memo's own thread, without unpacking it.
+        store = self._memo
+        future._memoize = True
+        future._add_inline_callback(lambda future: store.put_later(key, future._pop_memo_package))
         
     def submit(self, func, *args, **kwargs):
         """Schedules the given callable to be executed as ``func(*args, **kwargs)``.
@@ -247,38 +1443,266 @@ class Executor(_base.Executor):
         
         """
         
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        
         job = self._base_job(func, **extra)
-        work = qb.Work()
         package = self._base_work_package(func, args, kwargs, extra)
-        work['name'] = str(package.pop('name', '1'))
-        work['package'] = utils.pack(package)
-        job['agenda'] = [work]
-        return self._submit(job)[0]
+        
+        if self._coalescer is not None:
+            return self._memoized(package, lambda: self._coalescer.add(job, qb.Work(), package))
+        
+        return self._memoized(package, lambda: self._submit(self._single_job(job, package))[0])
     
     def map(self, func, *iterables, **extra):
         """Equivalent to ``map(func, *iterables)`` except ``func`` is executed
         asynchronously on Qube.
         
         :param timeout: The number of seconds to wait for results, or ``None``.
+        :param int chunksize: How many calls to execute within each work item.
+        :param float hedge_remaining: Once no more than this fraction of the
+            work items are outstanding, duplicate those which are straggling.
+        :param float hedge_factor: Work items are straggling once they have
+            been running this many times longer than the median of those which
+            have finished; 2 by default.
         
         Any other keyword arguments will be passed through to the ``qb.Job``::
         
             >>> for result in Executor().map(my_function, range(10), cpus=4):
             ...     print result
         
+        Mapping over many small inputs is dominated by the overhead of each
+        work item; a ``chunksize`` will group that many calls into each work
+        item, although each call still has its own result or exception.
+        
+        A few work items stuck on a slow host can hold up the whole map; with
+        ``hedge_remaining`` they are submitted again (avoiding those hosts), the
+        first attempt to succeed wins, and the other is killed::
+        
+            >>> executor.map(render_frame, frames, hedge_remaining=0.05)
+        
+        """
+        
+        chunksize = extra.pop('chunksize', None)
+        hedge = self._pop_hedge(extra)
+        futures = self._submit_map(func, zip(*iterables), extra, chunksize, hedge=hedge)
+        return self._map_iter(futures, extra.get('timeout'))
+    
+    @staticmethod
+    def _pop_hedge(extra):
+        remaining = extra.pop('hedge_remaining', None)
+        factor = extra.pop('hedge_factor', 2.0)
+        return (remaining, factor) if remaining else None
+    
+    def imap(self, func, *iterables, **extra):
+        """Like :meth:`map`, except the iterables are consumed lazily.
+        
+        :param int max_pending: How many calls may be submitted but not yet
+            returned at once.
+        :param int jobsize: How many calls to submit within each job.
+        :param int reorder_buffer: How many results which finished out of order
+            may be held before we stop submitting more calls, or ``None``.
+        :param timeout: The number of seconds to wait for results, or ``None``.
+        :param int chunksize: How many calls to execute within each work item.
+        
+        Calls are submitted as a series of jobs of no more than ``jobsize``
+        calls each, and further jobs are only submitted as results are
+        consumed. This is suitable for very long (or infinite) iterables, as
+        memory use does not grow with their length, and the first jobs start
+        running without waiting for the rest to be submitted::
+        
+            >>> for result in Executor().imap(my_function, itertools.count(), jobsize=100):
+            ...     print result
+        
+        Any other keyword arguments will be passed through to each ``qb.Job``.
+        
+        """
+        return self._imap(func, iterables, extra, ordered=True)
+    
+    def imap_unordered(self, func, *iterables, **extra):
+        """Like :meth:`imap`, except results are returned as soon as they
+        finish, instead of in order.
+        
+        Takes the same arguments as :meth:`imap`, except ``reorder_buffer``.
+        
+        """
+        return self._imap(func, iterables, extra, ordered=False)
+    
+    def _imap(self, func, iterables, extra, ordered):
+        
+        options = dict(
+            chunksize=extra.pop('chunksize', None),
+            max_pending=extra.pop('max_pending', 1000),
+            jobsize=extra.pop('jobsize', 100),
+            reorder_buffer=extra.pop('reorder_buffer', None) if ordered else None,
+            timeout=extra.get('timeout'),
+        )
+        
+        # Make sure that errors are raised immediately, instead of when the
+        # first result is requested.
+        self._base_job(func, **extra)
+        
+        return self._imap_iter(func, itertools.izip(*iterables), extra, ordered, **options)
+    
+    def _imap_iter(self, func, arg_tuples, extra, ordered, chunksize, max_pending, jobsize, reorder_buffer, timeout):
+        
+        if timeout is not None:
+            end_time = timeout + time.time()
+        
+        # Futures are put into the queue with their index as they finish.
+        finished = queue.Queue()
+        
+        # Futures which are submitted but have not been returned, and those
+        # which finished out of order, by index.
+        pending = {}
+        reordered = {}
+        next_index = 0
+        
+        submitted = 0
+        exhausted = False
+        
+        try:
+            while True:
+                
+                # Top up the pending calls with another job, if there is room.
+                room = max_pending - len(pending)
+                if (not exhausted and room >= min(jobsize, max_pending) and
+                    (reorder_buffer is None or len(reordered) < reorder_buffer)
+                ):
+                    arg_chunk = list(itertools.islice(arg_tuples, min(jobsize, room)))
+                    futures = self._submit_map(func, arg_chunk, extra, chunksize, offset=submitted) if arg_chunk else ()
+                    for index, future in enumerate(futures, submitted):
+                        pending[index] = future
+                        future._add_inline_callback(lambda f, index=index: finished.put((index, f)))
+                    submitted += len(arg_chunk)
+                    exhausted = len(arg_chunk) < min(jobsize, room)
+                    continue
+                
+                if not pending:
+                    return
+                
+                if next_index in reordered:
+                    future = reordered.pop(next_index)
+                    del pending[next_index]
+                    next_index += 1
+                    yield future.result(0)
+                    continue
+                
+                try:
+                    if timeout is None:
+                        index, future = finished.get()
+                    else:
+                        index, future = finished.get(True, max(0, end_time - time.time()))
+                except queue.Empty:
+                    raise _base.TimeoutError()
+                
+                if ordered:
+                    reordered[index] = future
+                else:
+                    del pending[index]
+                    yield future.result(0)
+        
+        finally:
+            cancel(pending.itervalues())
+    
+    def _submit_map(self, func, arg_tuples, extra, chunksize=None, offset=0, hedge=None):
+        """Submit a job to call the function with every tuple of arguments.
+        
+        :param tuple hedge: ``(remaining, factor)`` to duplicate stragglers.
+        :returns: The list of futures, one for every call.
+        
+        """
+        job, work_futures, futures = self._map_job(func, arg_tuples, extra, chunksize, offset)
+        self._submit(job, work_futures)
+        if hedge and work_futures:
+            _Hedger(self, job, work_futures, *hedge).start()
+        return futures
+    
+    def _map_job(self, func, arg_tuples, extra, chunksize=None, offset=0):
+        """Build a job to call the function with every tuple of arguments.
+        
+        :returns: A tuple of the job, the futures for every work item, and the
+            futures for every call.
+        
         """
         
         job = self._base_job(func, **extra)
+        shared_package = self._base_work_package(func, None, None, extra)
+        work_futures = []
         
-        for i, args in enumerate(zip(*iterables)):
-            work = qb.Work()
-            package = self._base_work_package(func, args, None, extra)
-            work['name'] = package.pop('name', str(i + 1))
-            work['package'] = utils.pack(package)
-            job['agenda'].append(work)
+        def submit(arg_tuples):
+            works, new_work_futures, futures = self._map_futures(
+                job, 'map', shared_package, arg_tuples, lambda work: Future(0, 0), chunksize, offset)
+            job['agenda'].extend(works)
+            work_futures.extend(new_work_futures)
+            return futures
         
-        futures = self._submit(job)
-        return self._map_iter(futures, extra.get('timeout'))
+        futures = self._memoized_map(shared_package, arg_tuples, submit)
+        return job, work_futures, futures
+    
+    def _map_futures(self, job, shared_key, shared_package, arg_tuples, make_future, chunksize=None, offset=0):
+        """Build the work items and futures for a map, whether it is its own
+        job or part of a batch.
+        
+        The parts of the call common to every item are only stored once, on
+        the job under ``shared_key``.
+        
+        :param make_future: Called with each unchunked ``qb.Work`` to get its
+            future; chunked ones always get a :class:`ChunkFuture`.
+        :returns: A tuple of the work items, the futures for every work item,
+            and the futures for every call.
+        
+        """
+        
+        package = dict(shared_package)
+        name = package.pop('name', None)
+        job['package'][shared_key] = utils.pack(package)
+        
+        works = []
+        work_futures = []
+        futures = []
+        for work, chunk in self._map_works(shared_key, name, arg_tuples, chunksize, offset):
+            works.append(work)
+            if chunk is None:
+                future = make_future(work)
+                futures.append(future)
+            else:
+                future = ChunkFuture(work)
+                futures.extend(future.element(i) for i in xrange(len(chunk)))
+            work_futures.append(future)
+        return works, work_futures, futures
+    
+    def _map_works(self, shared_key, name, arg_tuples, chunksize=None, offset=0):
+        """Build the work items for a map.
+        
+        :returns: An iterator of ``(work, chunk)`` tuples, where ``chunk`` is
+            the list of argument tuples in that work item if it is chunked.
+        
+        """
+        
+        if not chunksize or chunksize < 2:
+            for i, args in enumerate(arg_tuples):
+                work = qb.Work()
+                work['name'] = str(offset + i + 1) if name is None else name
+                work['package'] = self._pack_map_work({'shared': shared_key, 'args': args})
+                yield work, None
+            return
+        
+        for start in xrange(0, len(arg_tuples), chunksize):
+            chunk = arg_tuples[start:start + chunksize]
+            work = qb.Work()
+            work['name'] = '%d-%d' % (offset + start + 1, offset + start + len(chunk)) if name is None else name
+            work['package'] = self._pack_map_work({'shared': shared_key, 'chunk': chunk})
+            yield work, chunk
+    
+    def _pack_map_work(self, package):
+        depends = set()
+        for key in ('args', 'chunk'):
+            if key in package:
+                package[key] = self._reference_futures(package[key], depends)
+        if depends:
+            package['depends'] = sorted(depends)
+        return utils.pack(package)
     
     def _map_iter(self, futures, timeout):
         if timeout is not None:
@@ -290,13 +1714,21 @@ class Executor(_base.Executor):
                 else:
                     yield future.result(end_time - time.time())
         finally:
-            for future in futures:
-                future.cancel()
+            cancel(futures)
+    
+    def _as_completed_iter(self, futures, timeout):
+        try:
+            for future in as_completed(futures, timeout):
+                yield future.result(0)
+        finally:
+            cancel(futures)
     
     def batch(self, name=None, **kwargs):
         """Start a batch process.
         
         :param str name: The name of the Qube job.
+        :param float hedge_remaining: As for :meth:`map`.
+        :param float hedge_factor: As for :meth:`map`.
         :param \**kwargs: Other parameters for the Qube job.
         :returns: The :class:`~qbfutures.core.Batch` to use to schedule jobs in a batch.
         
@@ -310,8 +1742,26 @@ class Executor(_base.Executor):
         """
         if name is not None:
             kwargs['name'] = name
+        hedge = self._pop_hedge(kwargs)
         job = self._base_job(None, **kwargs)
-        return Batch(self, job)
+        return Batch(self, job, hedge=hedge)
+    
+    def submit_many(self):
+        """Start gathering many jobs to submit at once.
+        
+        :returns: The :class:`~qbfutures.core.MultiBatch` to schedule jobs with.
+        
+        ::
+            >>> with Executor().submit_many() as many:
+            ...     f1 = many.submit(first_function)
+            ...     f2 = many.submit_ext(second_function, cpus=8)
+            ...     with many.batch('Third') as batch:
+            ...         f3 = batch.submit(third_function)
+            ...
+            >>> print f1.result()
+        
+        """
+        return MultiBatch(self)
 
 
 
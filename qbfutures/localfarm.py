@@ -0,0 +1,488 @@
+"""A simulated Qube farm which runs entirely on the local host.
+
+This module is a stand-in for the ``qb`` module, providing enough of its API
+(:func:`submit`, :func:`jobinfo`, :func:`kill`, :func:`killwork`,
+:func:`jobobj`, :func:`requestwork`, :func:`reportwork` and
+:func:`reportjob`) for both sides of qbfutures to run
+unmodified. Submitted agendas are executed by a pool of local worker processes,
+each of which runs the real :func:`qbfutures.worker.main`, which in turn spawns
+its children exactly as it would on the farm.
+
+It is enabled by setting ``QBFUTURES_LOCALFARM`` to the number of workers to
+run before :mod:`qbfutures` is first imported::
+
+    $ QBFUTURES_LOCALFARM=8 python -m qbfutures.test.benchmark
+
+The first process to talk to the farm hosts it, and the workers it spawns
+connect back to it via ``QBFUTURES_LOCALFARM_ADDRESS``.
+
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import collections
+import itertools
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from . import utils
+
+
+class Job(dict):
+    pass
+
+
+class Work(dict):
+    pass
+
+
+class LocalFarm(object):
+
+    """The supervisor, and the pool of workers which it dispatches to.
+
+    :param int workers: How many worker processes may run at once.
+    :param str log_path: Where the workers should write their logs; they are
+        discarded by default.
+    :param str python: The interpreter to run workers with; defaults to this one.
+
+    """
+
+    POLL_DELAY = 0.02
+
+    # What each state in a ``link-<state>-job-<id>`` dependency accepts.
+    LINK_STATES = {
+        'complete': ('complete', ),
+        'failed': ('failed', ),
+        'killed': ('killed', ),
+        'done': ('complete', 'failed', 'killed'),
+    }
+
+    def __init__(self, workers=4, log_path=None, python=None):
+
+        self.workers = workers
+        self.log_path = log_path
+        self.python = python or sys.executable
+
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+
+        # Indices of pending work for each job, and the order in which jobs
+        # will be given workers.
+        self.pending = {}
+        self.queue = collections.deque()
+
+        # Worker processes keyed by (job_id, sub_id), the work index they are
+        # currently holding, and how many instances each job is running.
+        self.processes = {}
+        self.holding = {}
+        self.instances = collections.defaultdict(int)
+        self.sub_ids = collections.defaultdict(itertools.count)
+
+        self.stats = collections.defaultdict(float)
+
+        self.address = None
+        self.authkey = os.urandom(16)
+
+    def start(self):
+        """Start serving to workers, and dispatching work to them."""
+
+        if self.running:
+            return
+        self.running = True
+
+        manager = _FarmManager(address=('127.0.0.1', 0), authkey=self.authkey)
+        server = manager.get_server()
+        self.address = server.address
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        thread = threading.Thread(target=self._dispatch_loop)
+        thread.daemon = True
+        thread.start()
+
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """Stop dispatching work, and kill any running workers."""
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            for proc in self.processes.values():
+                self._kill_process(proc)
+
+    def get_stats(self):
+        """Get a copy of the counters for the supervisor side of the farm."""
+        with self.lock:
+            return dict(self.stats)
+
+
+    ## Client API.
+
+    def submit(self, jobs):
+
+        start_time = time.time()
+        submitted = []
+
+        with self.lock:
+
+            for job in jobs:
+
+                job = dict(job)
+                job['id'] = next(self.job_ids)
+                job['cpus'] = int(job.get('cpus') or 1)
+                job['timesubmit'] = start_time
+                job['todotally'] = collections.defaultdict(int)
+
+                agenda = []
+                for work_id, work in enumerate(job.get('agenda') or ()):
+                    work = dict(work)
+                    work.update(id=work_id, status='pending', resultpackage=None,
+                        timestart=None, timecomplete=None)
+                    agenda.append(work)
+                job['agenda'] = agenda
+                job['todotally']['pending'] = len(agenda)
+                self._update_job_status(job)
+
+                self.jobs[job['id']] = job
+                self.pending[job['id']] = collections.deque(xrange(len(agenda)))
+                self.queue.append(job['id'])
+                submitted.append(self._job_info(job))
+
+            self.stats['submit_calls'] += 1
+            self.stats['submit_jobs'] += len(submitted)
+            self.stats['submit_work'] += sum(len(self.jobs[j['id']]['agenda']) for j in submitted)
+            self.stats['submit_time'] += time.time() - start_time
+
+        self.wakeup.set()
+        return submitted
+
+    def jobinfo(self, id=None, agenda=False, **kwargs):
+
+        start_time = time.time()
+
+        with self.lock:
+
+            if id is None:
+                ids = sorted(self.jobs)
+            elif isinstance(id, (int, long)):
+                ids = [id]
+            else:
+                ids = list(id)
+
+            jobs = []
+            seen = set()
+            rows = 0
+            for job_id in ids:
+                if job_id in seen or job_id not in self.jobs:
+                    continue
+                seen.add(job_id)
+                job = self._job_info(self.jobs[job_id], agenda)
+                rows += len(job.get('agenda', ()))
+                jobs.append(job)
+
+            self.stats['jobinfo_calls'] += 1
+            self.stats['jobinfo_ids'] += len(ids)
+            self.stats['jobinfo_jobs'] += len(jobs)
+            self.stats['jobinfo_rows'] += rows
+            self.stats['jobinfo_time'] += time.time() - start_time
+
+        return jobs
+
+
+    def killwork(self, work_ids):
+        """Kill work by ``"job_id:work_id"`` strings, killing any workers running it."""
+
+        with self.lock:
+
+            killed = 0
+            for work_id in work_ids:
+
+                job_id, work_id = [int(x) for x in str(work_id).split(':')]
+                job = self.jobs.get(job_id)
+                if job is None or not 0 <= work_id < len(job['agenda']):
+                    continue
+                work = job['agenda'][work_id]
+                if work['status'] not in ('pending', 'running'):
+                    continue
+
+                self._set_work_status(job, work, 'killed')
+                work['timecomplete'] = time.time()
+                killed += 1
+
+                # Kill the worker (and its children) that is running it; it
+                # would be nice to only kill the child, but we don't know it.
+                for key, holding in self.holding.items():
+                    if key[0] == job_id and holding == work_id:
+                        proc = self.processes.get(key)
+                        if proc is not None:
+                            self._kill_process(proc)
+
+            self.stats['killwork_calls'] += 1
+            self.stats['killwork_work'] += killed
+
+    def kill(self, job_ids):
+        """Kill all unfinished work of the given jobs."""
+        with self.lock:
+            work_ids = []
+            for job_id in job_ids:
+                job = self.jobs.get(job_id)
+                if job is not None:
+                    work_ids.extend('%d:%d' % (job_id, work['id']) for work in job['agenda'])
+            self.killwork(work_ids)
+
+
+    ## Worker API.
+
+    def jobobj(self, job_id, sub_id):
+        with self.lock:
+            return self._job_info(self.jobs[job_id], agenda=True)
+
+    def requestwork(self, job_id, sub_id):
+        with self.lock:
+
+            job = self.jobs[job_id]
+            pending = self.pending[job_id]
+            while pending:
+                work = job['agenda'][pending.popleft()]
+                if work['status'] == 'pending':
+                    break
+            else:
+                return {'name': None, 'status': 'complete', 'package': {}}
+
+            self._set_work_status(job, work, 'running')
+            work['timestart'] = time.time()
+            self.holding[(job_id, sub_id)] = work['id']
+            return dict(work)
+
+    def reportwork(self, job_id, sub_id, work):
+        with self.lock:
+            job = self.jobs[job_id]
+            stored = job['agenda'][work['id']]
+            self.holding.pop((job_id, sub_id), None)
+            if stored['status'] != 'running':
+                return
+            stored['resultpackage'] = work.get('resultpackage')
+            stored['timecomplete'] = time.time()
+            self._set_work_status(job, stored, work['status'])
+
+    def reportjob(self, job_id, sub_id, status):
+        pass
+
+
+    ## Internals.
+
+    def _job_info(self, job, agenda=False):
+        info = dict((k, v) for k, v in job.iteritems() if k != 'agenda')
+        info['todotally'] = dict(job['todotally'])
+        if agenda:
+            info['agenda'] = [dict(work) for work in job['agenda']]
+        return info
+
+    def _set_work_status(self, job, work, status):
+        tally = job['todotally']
+        tally[work['status']] -= 1
+        tally[status] += 1
+        work['status'] = status
+        self._update_job_status(job)
+
+    def _update_job_status(self, job):
+        tally = job['todotally']
+        total = len(job['agenda'])
+        if tally['complete'] == total:
+            job['status'] = 'complete'
+        elif tally['complete'] + tally['failed'] + tally['killed'] == total:
+            job['status'] = 'killed' if tally['killed'] else 'failed'
+        elif tally['running']:
+            job['status'] = 'running'
+        elif not self._dependencies_met(job):
+            job['status'] = 'blocked'
+        else:
+            job['status'] = 'pending'
+
+    def _dependencies_met(self, job):
+        """Only ``link-<state>-job-<id>`` dependencies are supported."""
+        for link in (job.get('dependency') or '').split(','):
+            m = re.match(r'link-(\w+)-job-(\d+)$', link.strip())
+            if not m:
+                continue
+            other = self.jobs.get(int(m.group(2)))
+            if other is not None and other['status'] not in self.LINK_STATES.get(m.group(1), ()):
+                return False
+        return True
+
+    def _dispatch_loop(self):
+        while self.running:
+            self.wakeup.wait(self.POLL_DELAY)
+            self.wakeup.clear()
+            with self.lock:
+                self._reap_workers()
+                self._spawn_workers()
+
+    def _reap_workers(self):
+        for key, proc in self.processes.items():
+
+            code = proc.poll()
+            if code is None:
+                continue
+
+            del self.processes[key]
+            self.instances[key[0]] -= 1
+
+            # Fail any work that the worker was holding when it died.
+            work_id = self.holding.pop(key, None)
+            if work_id is not None:
+                job = self.jobs[key[0]]
+                work = job['agenda'][work_id]
+                if work['status'] != 'running':
+                    continue
+                work['resultpackage'] = utils.pack({
+                    'status': 'failed',
+                    'exception': RuntimeError('worker exited with code %d' % code),
+                })
+                work['timecomplete'] = time.time()
+                self._set_work_status(job, work, 'failed')
+
+    def _kill_process(self, proc):
+        if proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _spawn_workers(self):
+
+        free = self.workers - len(self.processes)
+        for job_id in list(self.queue):
+
+            if free <= 0:
+                return
+
+            if not self.pending[job_id]:
+                self.queue.remove(job_id)
+                continue
+
+            job = self.jobs[job_id]
+            if job['status'] == 'blocked':
+                self._update_job_status(job)
+                if job['status'] == 'blocked':
+                    continue
+
+            while free > 0 and self.instances[job_id] < min(job['cpus'], len(self.pending[job_id])):
+                self._spawn_worker(job)
+                free -= 1
+
+    def _spawn_worker(self, job):
+
+        sub_id = next(self.sub_ids[job['id']])
+
+        env = dict(os.environ)
+        env.update(job.get('env') or {})
+        env['QBJOBID'] = str(job['id'])
+        env['QBSUBID'] = str(sub_id)
+        env['QBFUTURES_LOCALFARM_ADDRESS'] = '%s:%d' % self.address
+        env['QBFUTURES_LOCALFARM_AUTHKEY'] = self.authkey.encode('hex')
+
+        # Make sure the workers (and their children) find this interpreter
+        # as "python", and this package.
+        env['PATH'] = os.pathsep.join(filter(None, (os.path.dirname(self.python), env.get('PATH'))))
+        root = os.path.abspath(os.path.join(__file__, '..', '..'))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (root, env.get('PYTHONPATH'))))
+
+        log_fh = open(self.log_path or os.devnull, 'a')
+        try:
+            proc = subprocess.Popen(
+                [self.python, '-c', 'from qbfutures.worker import main; main()'],
+                env=env, stdout=log_fh, stderr=subprocess.STDOUT, close_fds=True,
+                # Its own process group, so it can be killed with its children.
+                preexec_fn=os.setsid,
+            )
+        finally:
+            log_fh.close()
+
+        self.processes[(job['id'], sub_id)] = proc
+        self.instances[job['id']] += 1
+        self.stats['workers_spawned'] += 1
+
+
+class _FarmManager(BaseManager):
+    pass
+
+_FarmManager.register('get_farm', callable=lambda: _farm)
+
+
+_farm = None
+_farm_lock = threading.Lock()
+
+
+def get_farm():
+    """Get the farm for this process, connecting to or starting it as needed."""
+
+    global _farm
+
+    with _farm_lock:
+        if _farm is None:
+            address = os.environ.get('QBFUTURES_LOCALFARM_ADDRESS')
+            if address:
+                host, port = address.rsplit(':', 1)
+                authkey = os.environ['QBFUTURES_LOCALFARM_AUTHKEY'].decode('hex')
+                manager = _FarmManager(address=(host, int(port)), authkey=authkey)
+                manager.connect()
+                _farm = manager.get_farm()
+            else:
+                _farm = LocalFarm(workers=int(os.environ.get('QBFUTURES_LOCALFARM') or 4))
+                _farm.start()
+        return _farm
+
+
+def install():
+    """Replace the ``qb`` module with this one."""
+    sys.modules['qb'] = sys.modules[__name__]
+
+
+def _worker_key():
+    return int(os.environ['QBJOBID']), int(os.environ['QBSUBID'])
+
+
+def submit(jobs):
+    jobs = [dict(job, agenda=[dict(work) for work in job.get('agenda') or ()]) for job in jobs]
+    return get_farm().submit(jobs)
+
+
+def jobinfo(id=None, agenda=False, **kwargs):
+    return get_farm().jobinfo(id, agenda, **kwargs)
+
+
+def killwork(work_ids):
+    get_farm().killwork(list(work_ids))
+
+
+def kill(ids):
+    get_farm().kill(list(ids))
+
+
+def jobobj():
+    return get_farm().jobobj(*_worker_key())
+
+
+def requestwork():
+    return get_farm().requestwork(*_worker_key())
+
+
+def reportwork(work):
+    get_farm().reportwork(*(_worker_key() + (dict(work), )))
+
+
+def reportjob(status):
+    get_farm().reportjob(*(_worker_key() + (status, )))
@@ -0,0 +1,242 @@
+"""A shared on-disk store of results, so that repeated calls skip the farm.
+
+An executor created with ``memoize`` looks up every call in the store before
+submitting it, keyed by a hash of the function, its arguments, and the
+interpreter (and Maya file and version) it would run in. Calls which are found
+finish immediately, and the results of those which aren't are stored once they
+succeed. Within one map, repeated calls are only submitted once.
+
+Results are stored still packed, as they came back from Qube, by a background
+thread; neither storing them nor looking them up unpickles them.
+
+The store is a directory (``QBFUTURES_MEMO_DIR``, or given to the executor)
+which may be shared between hosts. Entries older than
+``QBFUTURES_MEMO_MAX_AGE`` seconds (a week by default) are evicted, as are the
+least recently used ones once it holds more than ``QBFUTURES_MEMO_MAX_BYTES``
+(1GB by default).
+
+Only functions which pickle by reference (i.e. those at the top level of a
+module, or ``"package.module:function"`` strings) are memoized, and the key
+does not change when the function's code does; clear the store when it does.
+
+"""
+
+from __future__ import absolute_import
+
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import Queue as queue
+import threading
+import time
+
+from . import metrics
+from . import utils
+
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 1 << 30
+
+# How often each process looks for entries to evict.
+EVICT_INTERVAL = 60.0
+
+# Parts of the work package which affect the result.
+KEY_ATTRS = ('interpreter', 'filename', 'version')
+
+
+_hits = metrics.counter('qbfutures_memo_hits_total', 'Calls answered from the memo store.')
+_misses = metrics.counter('qbfutures_memo_misses_total', 'Calls not found in the memo store.')
+_duplicates = metrics.counter('qbfutures_memo_duplicates_total', 'Repeated calls within a map which were not submitted.')
+_stores = metrics.counter('qbfutures_memo_stores_total', 'Results written to the memo store.')
+_evictions = metrics.counter('qbfutures_memo_evictions_total', 'Entries evicted from the memo store.')
+
+
+def _hit_ratio():
+    lookups = _hits.value + _misses.value
+    return float(_hits.value) / lookups if lookups else None
+
+metrics.gauge('qbfutures_memo_hit_ratio', 'Fraction of memo lookups which were hits.', _hit_ratio)
+
+
+def make_key(package):
+    """Get the key for the call described by a work package.
+
+    :returns: A hex digest, or ``None`` if the call cannot be memoized.
+
+    """
+    kwargs = package.get('kwargs') or {}
+    identity = (
+        package['func'],
+        tuple(package.get('args') or ()),
+        sorted(kwargs.iteritems()),
+        [(name, package.get(name)) for name in KEY_ATTRS],
+    )
+    try:
+        data = pickle.dumps(identity, 2)
+    except Exception:
+        # Lambdas, bound methods, and the like.
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+class Store(object):
+
+    """A directory of pickled result packages, by key."""
+
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = int(max_bytes or os.environ.get('QBFUTURES_MEMO_MAX_BYTES') or DEFAULT_MAX_BYTES)
+        self.max_age = float(max_age or os.environ.get('QBFUTURES_MEMO_MAX_AGE') or DEFAULT_MAX_AGE)
+        self._last_evict = 0
+        self._evict_lock = threading.Lock()
+        self._pending = None
+        self._pending_lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """Look up a result package.
+
+        :returns: ``(True, package)`` if found, otherwise ``(False, None)``.
+
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                stat = os.fstat(fh.fileno())
+                if stat.st_mtime < time.time() - self.max_age:
+                    raise IOError(errno.ENOENT, 'expired')
+                package = pickle.load(fh)
+        except Exception:
+            _misses.inc()
+            return False, None
+
+        # The access time tracks use (for eviction), and the modification time
+        # when it was stored (for expiry).
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+
+        _hits.inc()
+        return True, package
+
+    def put(self, key, package):
+        """Store a result package; best-effort, returning whether it was stored."""
+        try:
+            data = pickle.dumps(package, -1)
+        except Exception:
+            return False
+
+        path = self._path(key)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            utils.atomic_write(path, data)
+        except (IOError, OSError):
+            return False
+
+        _stores.inc()
+        if time.time() - self._last_evict > EVICT_INTERVAL:
+            self.evict()
+        return True
+
+    def put_later(self, key, get_package):
+        """Store a result package from a background thread, so that neither
+        the pickling, the writing, nor any eviction holds up the caller.
+
+        :param get_package: Called from that thread to get the package; it
+            is not stored if that returns ``None`` or raises.
+
+        """
+        with self._pending_lock:
+            if self._pending is None:
+                self._pending = queue.Queue()
+                thread = threading.Thread(target=self._put_loop, name='qbfutures-memo')
+                thread.daemon = True
+                thread.start()
+        self._pending.put((key, get_package))
+
+    def _put_loop(self):
+        while True:
+            key, get_package = self._pending.get()
+            try:
+                package = get_package()
+            except Exception:
+                package = None
+            if package is not None:
+                self.put(key, package)
+            # Let go of the future, so that its spooled file may be removed.
+            del get_package
+
+    def evict(self):
+        """Remove expired entries, and then the least recently used ones until
+        the store is small enough.
+
+        :returns: How many entries were removed.
+
+        """
+
+        with self._evict_lock:
+            self._last_evict = now = time.time()
+
+            entries = []
+            expired = []
+            for dir_path, dir_names, file_names in os.walk(self.directory):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if stat.st_mtime < now - self.max_age:
+                        expired.append(path)
+                    elif file_name.endswith('.pkl'):
+                        entries.append((stat.st_atime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            while entries and total > self.max_bytes:
+                _, size, path = entries.pop(0)
+                expired.append(path)
+                total -= size
+
+            for path in expired:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+            _evictions.inc(len(expired))
+            return len(expired)
+
+    def clear(self):
+        """Remove every entry."""
+        max_age, self.max_age = self.max_age, -1
+        try:
+            return self.evict()
+        finally:
+            self.max_age = max_age
+
+
+def get_store(spec):
+    """Get a :class:`Store` from an executor's ``memoize`` argument.
+
+    :param spec: A :class:`Store`, a directory, or ``True`` for
+        ``QBFUTURES_MEMO_DIR``.
+
+    """
+    if isinstance(spec, Store):
+        return spec
+    if isinstance(spec, basestring):
+        return Store(spec)
+    directory = os.environ.get('QBFUTURES_MEMO_DIR')
+    if not directory:
+        raise ValueError('memoize requires a directory or QBFUTURES_MEMO_DIR')
+    return Store(directory)
@@ -0,0 +1,258 @@
+"""Counters, gauges, and histograms describing what qbfutures is doing.
+
+The current values may be read via :func:`snapshot`::
+
+    >>> qbfutures.metrics.snapshot()['qbfutures_poller_delay_seconds']
+    0.1
+
+They may also be written in the Prometheus text format to a file, e.g. for the
+node exporter's textfile collector, either via :func:`dump`, or periodically by
+setting ``QBFUTURES_METRICS_FILE`` (and ``QBFUTURES_METRICS_INTERVAL``, which
+is 15 seconds by default) or calling :func:`start_dumping`. The former starts
+once the poller is, i.e. when work is first submitted, rather than on import.
+
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import collections
+import os
+import threading
+import time
+
+from . import utils
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def format(self):
+        return ['%s %s' % (self.name, _format_value(self.value))]
+
+
+class Gauge(object):
+
+    """A value which is read from the given function when requested."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def snapshot(self):
+        return self.func()
+
+    def format(self):
+        return ['%s %s' % (self.name, _format_value(self.func()))]
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager which observes how long its body takes."""
+        return _Timer(self)
+
+    def snapshot(self):
+        with self.lock:
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'mean': float(self.sum) / self.count if self.count else None,
+                'buckets': buckets,
+            }
+
+    def format(self):
+        snapshot = self.snapshot()
+        lines = []
+        for bound, count in snapshot['buckets']:
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, _format_value(bound), count))
+        lines.append('%s_sum %s' % (self.name, _format_value(snapshot['sum'])))
+        lines.append('%s_count %d' % (self.name, snapshot['count']))
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class RecentRate(object):
+
+    """Counts events within a sliding window, e.g. polls per minute."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, window=60.0):
+        self.name = name
+        self.help = help
+        self.window = window
+        self.times = collections.deque()
+        self.lock = threading.Lock()
+
+    def mark(self):
+        with self.lock:
+            now = time.time()
+            self.times.append(now)
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.times and self.times[0] < now - self.window:
+            self.times.popleft()
+
+    def snapshot(self):
+        with self.lock:
+            self._expire(time.time())
+            return len(self.times)
+
+    def format(self):
+        return ['%s %d' % (self.name, self.snapshot())]
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def rate(self, name, help, window=60.0):
+        return self._register(RecentRate(name, help, window))
+
+    def gauge(self, name, help, func):
+        """Register a gauge, replacing any previous one with the same name."""
+        gauge = Gauge(name, help, func)
+        with self.lock:
+            self.metrics[name] = gauge
+        return gauge
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+    def format_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.format())
+        return '\n'.join(lines) + '\n'
+
+
+#: The registry used by qbfutures itself.
+registry = Registry()
+
+counter = registry.counter
+histogram = registry.histogram
+rate = registry.rate
+gauge = registry.gauge
+snapshot = registry.snapshot
+
+
+def dump(path):
+    """Write all metrics to the given file in the Prometheus text format."""
+    utils.atomic_write(path, registry.format_prometheus())
+
+
+_dumper = None
+
+
+def start_dumping(path, interval=15.0):
+    """Dump all metrics to the given file every ``interval`` seconds."""
+
+    global _dumper
+    if _dumper is not None:
+        return
+
+    def target():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(path)
+            except (IOError, OSError):
+                pass
+
+    _dumper = threading.Thread(target=target)
+    _dumper.daemon = True
+    _dumper.start()
+
+
+def start_dumping_from_environ():
+    """Start dumping if requested via ``QBFUTURES_METRICS_FILE``.
+
+    Called when the poller starts, rather than on import.
+
+    """
+    if os.environ.get('QBFUTURES_METRICS_FILE'):
+        start_dumping(os.environ['QBFUTURES_METRICS_FILE'], float(os.environ.get('QBFUTURES_METRICS_INTERVAL') or 15))
@@ -0,0 +1,77 @@
+"""Push notification of finished work from the workers to the client.
+
+When enabled (via ``notify=True`` on the executor, or ``QBFUTURES_NOTIFY`` in
+the client's environment) the client listens on a UDP socket, whose address is
+passed to the jobs as ``QBFUTURES_NOTIFY_ADDRESS``. Workers send a tiny
+datagram to it after reporting each work item, so the poller can fetch that
+job immediately instead of waiting for its next poll.
+
+Notifications are only hints; they carry no results and may be lost, so the
+poller still polls every job, only much less often. The host advertised to the
+workers may be overridden with ``QBFUTURES_NOTIFY_HOST``.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import socket
+import threading
+
+
+def format_message(job_id, work_id):
+    return '%d:%d' % (job_id, work_id)
+
+
+def parse_message(data):
+    """Parse a notification into ``(job_id, work_id)``, or ``None``."""
+    try:
+        job_id, work_id = data.split(':')
+        return int(job_id), int(work_id)
+    except ValueError:
+        return None
+
+
+def send(address, job_id, work_id):
+    """Notify the client at the given address that a work item has finished.
+
+    This is best-effort; any errors are ignored.
+
+    """
+    try:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(format_message(job_id, work_id), (host, int(port)))
+        finally:
+            sock.close()
+    except (ValueError, socket.error):
+        pass
+
+
+class Listener(threading.Thread):
+
+    """Receives notifications, calling ``callback(job_id, work_id)`` for each."""
+
+    def __init__(self, callback):
+        super(Listener, self).__init__()
+        self.daemon = True
+
+        self.callback = callback
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        host = os.environ.get('QBFUTURES_NOTIFY_HOST') or socket.gethostname()
+
+        #: The ``host:port`` to pass to the workers.
+        self.address = '%s:%d' % (host, self.sock.getsockname()[1])
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(64)
+            except socket.error:
+                return
+            parsed = parse_message(data)
+            if parsed is not None:
+                self.callback(*parsed)
@@ -0,0 +1,350 @@
+"""A daemon which polls Qube on behalf of every client process on a host.
+
+Every process which uses :mod:`qbfutures` normally polls the supervisor itself.
+When many of them run on one host, it is cheaper to have them share a single
+daemon which merges all of their work into the same ``qb.jobinfo`` calls::
+
+    $ python -m qbfutures.polld
+
+The daemon is opt-in: clients only use it if ``QBFUTURES_POLLD_SOCKET`` is set
+to the socket it is listening on, and otherwise poll for themselves. Clients
+also fall back to polling themselves if the daemon goes away.
+
+Each user runs their own daemon. By default it listens in a directory under the
+system's temporary directory which only that user may access, and on Linux both
+ends also check that the other is run by the same user. Messages are JSON in
+both directions, so neither end ever unpickles what it is sent.
+
+"""
+
+from __future__ import absolute_import
+
+import errno
+import json
+import os
+import Queue as queue
+import signal
+import socket
+import struct
+import stat
+import sys
+import tempfile
+import threading
+from optparse import OptionParser
+
+
+# From <sys/socket.h>; the socket module does not have it.
+SO_PEERCRED = 17
+
+
+def get_socket_path():
+    """Get the path of the daemon's socket, or ``None`` if clients should not
+    use one."""
+    return os.environ.get('QBFUTURES_POLLD_SOCKET') or None
+
+
+def get_default_socket_path():
+    """Get where the daemon listens by default; private to the current user."""
+    return os.path.join(tempfile.gettempdir(), 'qbfutures-polld-%d' % os.getuid(), 'polld.sock')
+
+
+def make_private_dir(path):
+    """Create a directory only the current user may access, or check that an
+    existing one is.
+
+    :raises OSError: If it exists but is not private.
+
+    """
+    try:
+        os.mkdir(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0077:
+        raise OSError(errno.EPERM, 'not a private directory', path)
+
+
+def get_peer_uid(sock):
+    """Get the user on the other end of a UNIX socket, or ``None`` if that
+    cannot be determined on this platform."""
+    if not sys.platform.startswith('linux'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _is_trusted(sock):
+    uid = get_peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+def dumps(msg):
+    # Anything which JSON can't represent is only for display anyways. Byte
+    # strings are passed as Latin-1 so that they come back unchanged.
+    return json.dumps(msg, default=repr, encoding='latin-1')
+
+
+def loads(data):
+    return _decode(json.loads(data))
+
+
+def _decode(x):
+    # Back to the byte strings which everything else expects.
+    if isinstance(x, unicode):
+        try:
+            return x.encode('latin-1')
+        except UnicodeEncodeError:
+            return x.encode('utf8')
+    if isinstance(x, list):
+        return [_decode(v) for v in x]
+    if isinstance(x, dict):
+        return dict((_decode(k), _decode(v)) for k, v in x.iteritems())
+    return x
+
+
+def send_frame_data(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv_frame_data(sock):
+    """Receive a length-prefixed frame.
+
+    :raises EOFError: When the other end has been closed.
+
+    """
+    header = _recv_exactly(sock, 4)
+    return _recv_exactly(sock, struct.unpack('!I', header)[0])
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            raise EOFError('socket closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+class Client(object):
+
+    """A connection from a :class:`~qbfutures.poller.Poller` to the daemon.
+
+    Messages from the daemon are put into :attr:`messages`, followed by
+    ``None`` once the connection is lost.
+
+    """
+
+    def __init__(self, path, callback=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+            if not _is_trusted(self.sock):
+                raise socket.error(errno.EPERM, 'daemon is run by another user')
+        except socket.error:
+            self.sock.close()
+            raise
+        self.messages = queue.Queue()
+        self.callback = callback
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._read_loop)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, keys):
+        """Ask the daemon to report on the given ``(job_id, work_id)`` pairs."""
+        self._send({'watch': [list(key) for key in keys]})
+
+    def poll(self, job_ids):
+        """Ask the daemon to poll the given jobs right away."""
+        self._send({'poll': list(job_ids)})
+
+    def _send(self, msg):
+        with self.lock:
+            send_frame_data(self.sock, dumps(msg))
+
+    def _read_loop(self):
+        try:
+            while True:
+                self.messages.put(loads(recv_frame_data(self.sock)))
+                if self.callback:
+                    self.callback()
+        except Exception:
+            pass
+        self.messages.put(None)
+        if self.callback:
+            self.callback()
+
+    def close(self):
+        self.sock.close()
+
+
+class Watch(object):
+
+    """Stands in for the futures of every client watching one work item.
+
+    It is given to the daemon's poller in place of a real future, and relays
+    what the poller tells it to the clients.
+
+    """
+
+    def __init__(self, daemon, job_id, work_id):
+        self.daemon = daemon
+        self.job_id = job_id
+        self.work_id = work_id
+        self.conns = set()
+        self.status = None
+        self.work = None
+        self.finished = False
+
+    def done(self):
+        return self.finished or not self.conns
+
+    def _set_snapshot(self, job, work):
+        # The poller reads when it completed from here.
+        self.work = work
+        if work['status'] == self.status:
+            return
+        self.status = work['status']
+        job = dict((k, v) for k, v in job.iteritems() if k != 'agenda')
+        self.daemon.send(self, ('snapshot', self.job_id, self.work_id, job, work))
+
+    def set_resultpackage(self, package):
+        self.finished = True
+        self.daemon.send(self, ('finished', self.job_id, self.work_id, package))
+        self.daemon.release(self)
+
+    def set_exception(self, exception):
+        # Only called when the poller fails; the daemon will shut down and the
+        # clients will carry on by themselves.
+        self.finished = True
+
+
+class Daemon(object):
+
+    def __init__(self, path):
+
+        # Imported here since the poller imports us.
+        from . import poller
+        self.poller = poller.Poller(daemon_path=None)
+
+        self.path = path
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.listen(128)
+        self.sock.settimeout(1.0)
+
+    def serve_forever(self):
+        try:
+            while self.running:
+
+                # Let the clients carry on by themselves if we can't poll.
+                if self.poller.started and not self.poller.is_alive():
+                    print >> sys.stderr, 'qbfutures.polld: poller died'
+                    return
+
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                if not _is_trusted(conn):
+                    conn.close()
+                    continue
+                thread = threading.Thread(target=self._serve_client, args=(conn, ))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _serve_client(self, conn):
+        conn_lock = threading.Lock()
+        conn_key = (conn, conn_lock)
+        try:
+            while True:
+                msg = loads(recv_frame_data(conn))
+                if msg.get('watch'):
+                    with self.lock:
+                        for job_id, work_id in msg['watch']:
+                            watch = self.watches.get((job_id, work_id))
+                            if watch is None:
+                                watch = self.watches[(job_id, work_id)] = Watch(self, job_id, work_id)
+                                self.poller.add(watch)
+                            watch.conns.add(conn_key)
+                    self.poller.trigger()
+                for job_id in msg.get('poll') or ():
+                    self.poller.notify(job_id, None)
+        except (EOFError, socket.error, ValueError):
+            pass
+        finally:
+            self._drop(conn_key)
+            conn.close()
+
+    def _drop(self, conn_key):
+        with self.lock:
+            for key, watch in self.watches.items():
+                watch.conns.discard(conn_key)
+                if not watch.conns:
+                    del self.watches[key]
+
+    def send(self, watch, msg):
+        data = dumps(msg)
+        for conn_key in list(watch.conns):
+            conn, conn_lock = conn_key
+            try:
+                with conn_lock:
+                    send_frame_data(conn, data)
+            except socket.error:
+                # The client's thread will clean up after it.
+                watch.conns.discard(conn_key)
+
+    def release(self, watch):
+        with self.lock:
+            if self.watches.get((watch.job_id, watch.work_id)) is watch:
+                del self.watches[(watch.job_id, watch.work_id)]
+
+
+def main():
+
+    opt_parser = OptionParser()
+    opt_parser.add_option('-s', '--socket', default=get_socket_path())
+    opt_parser.add_option('--two-stage', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    # Make sure our socket is cleaned up when we are terminated.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    if not opts.socket:
+        opts.socket = get_default_socket_path()
+        make_private_dir(os.path.dirname(opts.socket))
+
+    daemon = Daemon(opts.socket)
+    daemon.poller.two_stage_polling = opts.two_stage
+    daemon.poller.register_gauges()
+    print 'qbfutures.polld: listening on %s' % opts.socket
+    print 'qbfutures.polld: set QBFUTURES_POLLD_SOCKET=%s for clients to use it' % opts.socket
+    sys.stdout.flush()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
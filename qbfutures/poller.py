@@ -1,14 +1,22 @@
 import atexit
 import Queue as queue
+import socket
 import threading
+import time
 import weakref
 import sys
 
 import qb
 
-from . import utils
+from . import metrics
+from . import notify
 
-__also_reload = ['.utils']
+
+_polls_per_minute = metrics.rate('qbfutures_poller_polls_per_minute', 'Calls to qb.jobinfo within the last minute.')
+_jobinfo_seconds = metrics.histogram('qbfutures_poller_jobinfo_seconds', 'Latency of qb.jobinfo calls.')
+_jobinfo_jobs = metrics.histogram('qbfutures_poller_jobinfo_jobs', 'Jobs returned by each qb.jobinfo call.', metrics.SIZE_BUCKETS)
+_jobinfo_rows = metrics.histogram('qbfutures_poller_jobinfo_rows', 'Agenda rows returned by each qb.jobinfo call.', metrics.SIZE_BUCKETS)
+_completion_lag = metrics.histogram('qbfutures_poller_completion_lag_seconds', 'Time from work completing on Qube to its future finishing.', metrics.LAG_BUCKETS)
 
 
 class Poller(threading.Thread):
@@ -16,40 +24,108 @@ class Poller(threading.Thread):
     MIN_DELAY = 0.1
     MAX_DELAY = 2.0
     
-    def __init__(self, two_stage_polling=False):
+    # How often to poll jobs whose workers will notify us of finished work;
+    # this is only a safety net in case a notification is lost.
+    NOTIFIED_MAX_DELAY = 30.0
+    
+    def __init__(self, two_stage_polling=False, daemon_path=None):
         super(Poller, self).__init__()
         self.daemon = True
         
         self.two_stage_polling = two_stage_polling
         
+        # Where to find the host's polling daemon (see qbfutures.polld), our
+        # connection to it, and the work we have yet to tell it about.
+        self.daemon_path = daemon_path
+        self.daemon_client = None
+        self.unwatched = []
+        
         self.futures = weakref.WeakValueDictionary()
+        
+        # Outstanding work IDs for every job we are watching, so that we can
+        # query each job once regardless of how many futures it has.
+        self.jobs = {}
+        
+        # How many work items of each job were finished at the last poll, so
+        # that two-stage polling can tell which jobs have made progress.
+        self.finished_counts = {}
+        
+        # The job-level fields of every job from its last poll, without the
+        # agenda; shared by all of its futures, and updated in place.
+        self.snapshots = {}
+        
+        # Jobs whose workers will notify us, and those they have notified us
+        # about since the last poll.
+        self.listener = None
+        self.notifying_jobs = set()
+        self.notified_jobs = set()
+        self.notified_lock = threading.Lock()
+        self.last_full_poll = 0
+        
         self.new_futures = queue.Queue()
         self.delay = self.MAX_DELAY
         self.loop_event = threading.Event()
         self.started = False
         self.running = True
     
-    def add(self, future):
+    def register_gauges(self):
+        """Expose our current state via :mod:`qbfutures.metrics`."""
+        metrics.gauge('qbfutures_poller_futures', 'Futures being polled.', lambda: len(self.futures))
+        metrics.gauge('qbfutures_poller_jobs', 'Jobs being polled.', lambda: len(self.jobs))
+        metrics.gauge('qbfutures_poller_queue_depth', 'New futures yet to be picked up by the poller.', self.new_futures.qsize)
+        metrics.gauge('qbfutures_poller_delay_seconds', 'Current delay between polls.', lambda: self.delay)
+    
+    def add(self, future, notifying=False):
         if not self.running:
             future.set_exception(RuntimeError('qbfutures poller shutdown'))
         else:
+            if notifying:
+                self.notifying_jobs.add(future.job_id)
             self.new_futures.put(future)
     
+    def listen(self):
+        """Start listening for notifications from workers.
+        
+        :returns: The address the workers should notify.
+        
+        """
+        if self.listener is None:
+            listener = notify.Listener(self.notify)
+            listener.start()
+            self.listener = listener
+        return self.listener.address
+    
+    def notify(self, job_id, work_id):
+        """Called when a worker tells us that it has finished some work."""
+        with self.notified_lock:
+            self.notified_jobs.add(job_id)
+        self.loop_event.set()
+    
     def trigger(self):
         self.delay = self.MIN_DELAY
+        self.last_full_poll = 0
         self.loop_event.set()
         if not self.started:
             self.started = True
+            metrics.start_dumping_from_environ()
             self.start()
             atexit.register(self.shutdown)
     
     def shutdown(self):
         self.running = False
         self.futures.clear()
+        self.jobs.clear()
+        self.finished_counts.clear()
+        self.snapshots.clear()
+        self.notifying_jobs.clear()
         self.loop_event.set()
         
+        # Wake the loop if it is blocked waiting for new futures.
+        self.new_futures.put(None)
+        
     def run(self):
         try:
+            self._connect_daemon()
             while self.running:
                 self.polling_loop()
         except Exception:
@@ -58,77 +134,254 @@ class Poller(threading.Thread):
             for future in self.futures.values():
                 future.set_exception(RuntimeError('qbfutures poller failed'))
             self.futures.clear()
+            self.jobs.clear()
+            self.finished_counts.clear()
+            self.snapshots.clear()
             raise
     
     def polling_loop(self):
             
         # Wait for a timer, or for someone to trigger us. We want to wait
         # slightly longer each time, but given the nature of qube a 2x
-        # increase in delay leads us to log waits too quickly.
-        self.delay = min(self.delay * 1.15, self.MAX_DELAY)
+        # increase in delay leads us to log waits too quickly. If every job
+        # will notify us (or the daemon is polling for us) then we only need to
+        # poll as a safety net.
+        if self.daemon_client is not None or (self.jobs and self.notifying_jobs.issuperset(self.jobs)):
+            self.delay = self.NOTIFIED_MAX_DELAY
+        else:
+            self.delay = min(self.delay * 1.15, self.MAX_DELAY)
         self.loop_event.wait(self.delay)
         if self.loop_event.is_set():
             self.loop_event.clear()
             
-        # Get all the new futures. If we don't have any and there aren't any
+        # Get all the new futures, so that each job is polled once no matter
+        # how many of them it has. If we don't have any and there aren't any
         # in the queue, then wait on the queue for something to show up.
-        queue_emptied = False
-        while not queue_emptied or not self.futures:
+        while True:
             try:
                 # Block while we don't have any futures.
                 future = self.new_futures.get(not self.futures)
-                
             except queue.Empty:
-                queue_emptied = True
-                
-            else:
-                self.futures[(future.job_id, future.work_id)] = future
-                    
-                # We did just get something from the queue, so it
-                # potentially has more. Keep emptying it without fear or
-                # re-entering the loop since futures will be non-empty.
-                queue_emptied = True
-                    
-                # Clean up so weak refs can vanish.
-                del future
+                break
+            if future is None:
+                return
+            
+            self.futures[(future.job_id, future.work_id)] = future
+            self.jobs.setdefault(future.job_id, set()).add(future.work_id)
+            
+            # Its work may have finished before the job's last tally, so the
+            # next two-stage poll must fetch the job regardless.
+            self.finished_counts.pop(future.job_id, None)
+            if self.daemon_client is not None:
+                self.unwatched.append((future.job_id, future.work_id))
             
-        # print 'QUICK POLL: %r' % self.futures.keys()
-        # Using `values` instead of `itervalues` for the weakref.
-        jobs = qb.jobinfo(id=[f.job_id for f in self.futures.values()], agenda=not self.two_stage_polling)
+            # Clean up so weak refs can vanish.
+            del future
+        
+        # Drop work that nobody holds a future for anymore, and jobs which no
+        # longer have any outstanding work.
+        self._prune_index()
+        if not self.jobs:
+            return
+        
+        with self.notified_lock:
+            notified = self.notified_jobs.intersection(self.jobs)
+            self.notified_jobs.clear()
+        
+        # Let the daemon do the polling, if there is one.
+        if self.daemon_client is not None and self._poll_via_daemon(notified):
+            return
+        
+        # Only fetch the jobs we were notified about, unless it is time for a
+        # full poll.
+        if notified and time.time() - self.last_full_poll < self.delay:
+            jobs = self._jobinfo(sorted(notified), True)
+            self._process(jobs)
+            return
+        
+        self.last_full_poll = time.time()
+        
+        # print 'QUICK POLL: %r' % self.jobs.keys()
+        jobs = self._jobinfo(sorted(self.jobs), not self.two_stage_polling)
         # print 'done quick poll'
             
         if self.two_stage_polling:
-            finished = [job['id'] for job in jobs if job['status'] in ('complete', 'failed')]
-            if not finished:
+            
+            # Keep the job-level fields fresh, even if its work is unchanged.
+            for job in jobs:
+                if job['id'] in self.snapshots:
+                    self._update_snapshot(job)
+            
+            progressed = [job['id'] for job in jobs if self._has_progressed(job)]
+            if not progressed:
                 return
             #print 'LONG POLL'
-            jobs = qb.jobinfo(id=finished, agenda=True)
+            jobs = self._jobinfo(progressed, True)
             #print 'done long poll'
-            
+        
+        self._process(jobs)
+    
+    def _jobinfo(self, job_ids, agenda):
+        _polls_per_minute.mark()
+        with _jobinfo_seconds.time():
+            jobs = qb.jobinfo(id=job_ids, agenda=agenda)
+        _jobinfo_jobs.observe(len(jobs))
+        if agenda:
+            _jobinfo_rows.observe(sum(len(job.get('agenda') or ()) for job in jobs))
+        return jobs
+    
+    def _finish(self, future, package):
+        
+        # This is unpacked lazily by the future.
+        future.set_resultpackage(package)
+        
+        # Compare against when Qube says the work completed.
+        completed = (future.work or {}).get('timecomplete')
+        if completed:
+            _completion_lag.observe(max(0, time.time() - completed))
+    
+    def _process(self, jobs):
+        """Update the futures from the results of a full ``qb.jobinfo``."""
+        
         for job in jobs:
-            for agenda_i, agenda in enumerate(job['agenda']):
-                if agenda['status'] not in ('complete', 'failed'):
-                    continue
+            
+            work_ids = self.jobs.get(job['id'])
+            if not work_ids:
+                continue
+            
+            snapshot = self._update_snapshot(job)
+            
+            # Only look at the rows we are still waiting on.
+            for work_id in sorted(work_ids):
                 
                 # Leave the future in the dict in case we fail before we report
                 # anything.
-                future = self.futures.get((job['id'], agenda_i))
-                if future is None:
+                future = self.futures.get((job['id'], work_id))
+                if future is None or future.done():
+                    self._forget(job['id'], work_id)
                     continue
                 
-                # Back up to full speed.
-                self.delay = self.MIN_DELAY
-                    
-                result = utils.unpack(agenda['resultpackage'])
+                # Keep the snapshots up to date so that statuses can be read
+                # without asking the supervisor.
+                agenda = job['agenda'][work_id]
+                future._set_snapshot(snapshot, agenda)
                 
-                if 'result' in result:
-                    future.set_result(result['result'])
-                elif 'exception' in result:
-                    future.set_exception(result['exception'])
-                else:
-                    future.set_exception(RuntimeError('invalid resultpackage'))
+                if agenda['status'] not in ('complete', 'failed'):
+                    del future
+                    continue
+                
+                # Back up to full speed, unless we will be told when the rest
+                # of this job finishes.
+                if job['id'] not in self.notifying_jobs:
+                    self.delay = self.MIN_DELAY
+                    
+                self._finish(future, agenda['resultpackage'])
                 
                 # Clean up so weak refs can vanish.
-                del self.futures[(job['id'], agenda_i)]
+                self._forget(job['id'], work_id)
                 del future
-
+    
+    def _update_snapshot(self, job):
+        # Futures only hold on to their own rows of the agenda, which is
+        # otherwise refetched (with every result package) on each poll.
+        snapshot = self.snapshots.setdefault(job['id'], {})
+        snapshot.update((k, v) for k, v in job.iteritems() if k != 'agenda')
+        return snapshot
+    
+    def _connect_daemon(self):
+        if not self.daemon_path:
+            return
+        from . import polld
+        try:
+            self.daemon_client = polld.Client(self.daemon_path, self.loop_event.set)
+        except socket.error:
+            return
+        self.unwatched = list(self.futures.keys())
+    
+    def _poll_via_daemon(self, notified):
+        """Relay our work to the daemon, and process what it has sent us.
+        
+        :returns: ``False`` if the daemon has gone away, and we must poll
+            ourselves.
+        
+        """
+        
+        client = self.daemon_client
+        try:
+            if self.unwatched:
+                client.watch(self.unwatched)
+                self.unwatched = []
+            if notified:
+                client.poll(sorted(notified))
+        except socket.error:
+            client.messages.put(None)
+        
+        while True:
+            
+            try:
+                msg = client.messages.get_nowait()
+            except queue.Empty:
+                break
+            
+            # The daemon went away; poll everything ourselves from now on.
+            if msg is None:
+                client.close()
+                self.daemon_client = None
+                self.delay = self.MIN_DELAY
+                self.last_full_poll = 0
+                return False
+            
+            type_, job_id, work_id = msg[:3]
+            future = self.futures.get((job_id, work_id))
+            if future is None or future.done():
+                continue
+            if type_ == 'snapshot':
+                future._set_snapshot(*msg[3:])
+            elif type_ == 'finished':
+                self._finish(future, msg[3])
+                self._forget(job_id, work_id)
+            del future
+        
+        return True
+    
+    def _forget(self, job_id, work_id):
+        self.futures.pop((job_id, work_id), None)
+        work_ids = self.jobs.get(job_id)
+        if work_ids is not None:
+            work_ids.discard(work_id)
+            if not work_ids:
+                self._forget_job(job_id)
+    
+    def _forget_job(self, job_id):
+        self.jobs.pop(job_id, None)
+        self.finished_counts.pop(job_id, None)
+        self.snapshots.pop(job_id, None)
+        self.notifying_jobs.discard(job_id)
+    
+    def _prune_index(self):
+        for job_id, work_ids in self.jobs.items():
+            for work_id in list(work_ids):
+                future = self.futures.get((job_id, work_id))
+                if future is None or future.done():
+                    self.futures.pop((job_id, work_id), None)
+                    work_ids.discard(work_id)
+            if not work_ids:
+                self._forget_job(job_id)
+    
+    def _has_progressed(self, job):
+        """Has this job finished more work since the last poll?
+        
+        Determined from the work tallies of a status-only poll; if they are
+        not available we must wait for the whole job to finish.
+        
+        """
+        
+        tally = job.get('todotally')
+        if not tally:
+            return job['status'] in ('complete', 'failed')
+        
+        count = tally.get('complete', 0) + tally.get('failed', 0)
+        if count == self.finished_counts.get(job['id'], 0):
+            return False
+        self.finished_counts[job['id']] = count
+        return True
@@ -0,0 +1,136 @@
+"""Out-of-band transport of large results via a shared spool directory.
+
+Results which pickle to more than ``QBFUTURES_SPOOL_THRESHOLD`` bytes (1MB by
+default) are written by the worker into ``QBFUTURES_SPOOL_DIR``, which must be
+visible to both the farm and the client, and only their path is reported back
+to Qube. Both may also be set per executor or call via the ``spool_dir`` and
+``spool_threshold`` keyword arguments.
+
+Files are removed once the future which owns them is collected, unless other
+work on the farm depends on that future and may still need to read them. Those,
+and files which are never claimed (e.g. the results of futures which were
+dropped before they finished), are swept up by the workers once they are older than
+``QBFUTURES_SPOOL_MAX_AGE`` seconds (a day by default).
+
+"""
+
+from __future__ import absolute_import
+
+import cPickle as pickle
+import errno
+import mmap
+import os
+import threading
+import time
+import uuid
+import weakref
+
+from . import utils
+
+
+DEFAULT_THRESHOLD = 1 << 20
+DEFAULT_MAX_AGE = 24 * 3600
+
+# How often the spool is swept; shared by everyone using it via a marker file.
+SWEEP_INTERVAL = 600
+
+
+def get_config(package):
+    """Get the ``(spool_dir, threshold)`` for the given work package."""
+    spool_dir = package.get('spool_dir') or os.environ.get('QBFUTURES_SPOOL_DIR')
+    threshold = package.get('spool_threshold') or os.environ.get('QBFUTURES_SPOOL_THRESHOLD')
+    return spool_dir, int(threshold or DEFAULT_THRESHOLD)
+
+
+def write(spool_dir, data, prefix=''):
+    """Write the given pickled data into the spool, returning its path."""
+
+    try:
+        os.makedirs(spool_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    path = os.path.join(spool_dir, '%s%s.pkl' % (prefix, uuid.uuid4().hex))
+    utils.atomic_write(path, data)
+    return path
+
+
+def sweep(spool_dir, max_age=None):
+    """Remove files older than ``max_age`` seconds from the spool, unless it
+    has been swept within the last :data:`SWEEP_INTERVAL` seconds.
+    
+    :returns: How many files were removed.
+    
+    """
+    
+    max_age = float(max_age or os.environ.get('QBFUTURES_SPOOL_MAX_AGE') or DEFAULT_MAX_AGE)
+    now = time.time()
+    
+    marker = os.path.join(spool_dir, '.swept')
+    try:
+        if os.path.getmtime(marker) > now - SWEEP_INTERVAL:
+            return 0
+    except OSError:
+        pass
+    try:
+        with open(marker, 'w'):
+            pass
+    except IOError:
+        return 0
+    
+    removed = 0
+    for name in os.listdir(spool_dir):
+        if not name.endswith(('.pkl', '.tmp')):
+            continue
+        path = os.path.join(spool_dir, name)
+        try:
+            if os.path.getmtime(path) < now - max_age:
+                os.unlink(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def load(path):
+    """Unpickle a spooled file by memory-mapping it."""
+    with open(path, 'rb') as fh:
+        buffer_ = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return pickle.load(buffer_)
+        finally:
+            buffer_.close()
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+# Weak references to objects which own spooled files, and the paths they own.
+_owners = {}
+_owners_lock = threading.Lock()
+
+
+def remove_with(owner, path):
+    """Remove the spooled file at the given path once the owner is collected."""
+
+    def callback(ref):
+        with _owners_lock:
+            _owners.pop(ref, None)
+        remove(path)
+
+    ref = weakref.ref(owner, callback)
+    with _owners_lock:
+        _owners[ref] = path
+
+
+def release(owner):
+    """Keep the files owned by the given object after it is collected."""
+    with _owners_lock:
+        for ref in [ref for ref in _owners if ref() is owner]:
+            del _owners[ref]
@@ -0,0 +1,226 @@
+"""End-to-end throughput benchmarks, run against the simulated local farm.
+
+Must be run with the local farm enabled::
+
+    $ QBFUTURES_LOCALFARM=8 python -m qbfutures.test.benchmark --sizes 10,1000
+
+Results may be saved with ``--save``, and later runs compared against them with
+``--baseline``, which exits with an error if any rate or latency regressed by
+more than ``--tolerance``. It also exits with an error if any benchmark polled
+the supervisor once per work item, since polls should follow the number of
+jobs instead.
+
+``lag`` is how long the client took to see the last result after the farm
+finished it.
+
+"""
+
+import json
+import sys
+import time
+from optparse import OptionParser
+
+from concurrent.futures import as_completed
+
+import qb
+
+from .. import core
+
+
+FUNC = 'qbfutures.test.work:func'
+
+
+def bench_submit(n, timeout):
+    executor = core.Executor(name='QBFutures Benchmark: submit')
+    start = time.time()
+    futures = [executor.submit(FUNC, i) for i in xrange(n)]
+    submitted = time.time()
+    first = None
+    for future in as_completed(futures, timeout):
+        future.result()
+        first = first or time.time()
+    return start, submitted, first
+
+
+def bench_map(n, timeout):
+    executor = core.Executor(name='QBFutures Benchmark: map', cpus=n)
+    start = time.time()
+    results = executor.map(FUNC, xrange(n), timeout=timeout)
+    submitted = time.time()
+    first = None
+    for result in results:
+        first = first or time.time()
+    return start, submitted, first
+
+
+def bench_batch(n, timeout):
+    executor = core.Executor()
+    start = time.time()
+    with executor.batch('QBFutures Benchmark: batch', cpus=n) as batch:
+        for i in xrange(n):
+            batch.submit(FUNC, i)
+    submitted = time.time()
+    first = None
+    for future in as_completed(batch.futures, timeout):
+        future.result()
+        first = first or time.time()
+    return start, submitted, first
+
+
+BENCHMARKS = [
+    ('submit', bench_submit),
+    ('map', bench_map),
+    ('batch', bench_batch),
+]
+
+# Metrics for which bigger is better; all others are latencies or costs.
+HIGHER_IS_BETTER = set(['rate'])
+
+
+def get_finished(job_ids):
+    """Get when the farm finished the last work item of the given jobs."""
+    times = [0]
+    for job in qb.jobinfo(id=job_ids, agenda=True):
+        times.extend(work.get('timecomplete') or 0 for work in job['agenda'])
+    return max(times)
+
+
+def run(name, func, n, timeout):
+
+    farm = qb.get_farm()
+    before = farm.get_stats()
+    before_jobs = set(farm.jobs)
+    start, submitted, first = func(n, timeout)
+    end = time.time()
+    after = farm.get_stats()
+    stats = dict((k, after.get(k, 0) - before.get(k, 0)) for k in after)
+    finished = get_finished(sorted(set(farm.jobs) - before_jobs))
+
+    polls = stats.get('jobinfo_calls', 0) or 1
+    jobs = stats.get('submit_jobs', 0) or 1
+    return {
+        'name': name,
+        'n': n,
+        'rate': n / (end - start),
+        'submit': submitted - start,
+        'first': first - start,
+        'total': end - start,
+        'lag': max(0, end - finished) if finished else 0,
+        'jobs': stats.get('submit_jobs', 0),
+        'polls': stats.get('jobinfo_calls', 0),
+        'polls_per_job': polls / jobs,
+        'ids_per_poll': stats.get('jobinfo_ids', 0) / polls,
+        'rows_per_poll': stats.get('jobinfo_rows', 0) / polls,
+        'poll_time': stats.get('jobinfo_time', 0),
+    }
+
+
+COLUMNS = [
+    ('name', '%-8s'),
+    ('n', '%8d'),
+    ('rate', '%10.1f'),
+    ('submit', '%8.3f'),
+    ('first', '%8.3f'),
+    ('total', '%9.3f'),
+    ('lag', '%7.3f'),
+    ('jobs', '%6d'),
+    ('polls', '%6d'),
+    ('polls_per_job', '%13.1f'),
+    ('ids_per_poll', '%12.1f'),
+    ('rows_per_poll', '%13.1f'),
+    ('poll_time', '%9.3f'),
+]
+
+
+def format_header():
+    return ' '.join('%*s' % (len(fmt % (0 if 'd' in fmt or 'f' in fmt else '')), name) for name, fmt in COLUMNS)
+
+
+def format_row(result):
+    return ' '.join(fmt % result[name] for name, fmt in COLUMNS)
+
+
+def compare(results, baseline, tolerance):
+
+    baseline = dict(((r['name'], r['n']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = baseline.get((result['name'], result['n']))
+        if old is None:
+            continue
+        for key in ('rate', 'submit', 'first', 'total', 'lag', 'poll_time'):
+            if key not in old:
+                continue
+            if key in HIGHER_IS_BETTER:
+                worse = result[key] < old[key] * (1 - tolerance)
+            else:
+                worse = result[key] > old[key] * (1 + tolerance)
+            if worse:
+                regressions.append('%s[%d] %s: %.3f -> %.3f' % (result['name'], result['n'], key, old[key], result[key]))
+    return regressions
+
+
+def check_scaling(results):
+    """Find benchmarks which polled once per work item, rather than per job."""
+    problems = []
+    for result in results:
+        if result['n'] > result['jobs'] and result['polls'] >= result['n']:
+            problems.append('%s[%d]: %d polls for %d jobs' % (result['name'], result['n'], result['polls'], result['jobs']))
+    return problems
+
+
+def main():
+
+    opt_parser = OptionParser()
+    opt_parser.add_option('-s', '--sizes', default='10,1000,100000')
+    opt_parser.add_option('-b', '--benchmarks', default=','.join(name for name, _ in BENCHMARKS))
+    opt_parser.add_option('-t', '--timeout', type='float', default=3600)
+    opt_parser.add_option('--two-stage', action='store_true')
+    opt_parser.add_option('--save')
+    opt_parser.add_option('--baseline')
+    opt_parser.add_option('--tolerance', type='float', default=0.25)
+    opts, args = opt_parser.parse_args()
+
+    if not hasattr(qb, 'get_farm'):
+        print 'benchmarks must run against the local farm; set QBFUTURES_LOCALFARM'
+        sys.exit(2)
+
+    core._poller.two_stage_polling = opts.two_stage
+
+    sizes = [int(x) for x in opts.sizes.split(',')]
+    names = opts.benchmarks.split(',')
+
+    print format_header()
+    results = []
+    for n in sizes:
+        for name, func in BENCHMARKS:
+            if name not in names:
+                continue
+            result = run(name, func, n, opts.timeout)
+            results.append(result)
+            print format_row(result)
+            sys.stdout.flush()
+
+    if opts.save:
+        with open(opts.save, 'w') as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+
+    failed = False
+
+    for line in check_scaling(results):
+        print 'SCALING', line
+        failed = True
+
+    if opts.baseline:
+        with open(opts.baseline) as fh:
+            regressions = compare(results, json.load(fh), opts.tolerance)
+        for line in regressions:
+            print 'REGRESSION', line
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
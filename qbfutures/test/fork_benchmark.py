@@ -0,0 +1,88 @@
+"""Compare per-task preflights against reused children and the fork server.
+
+By default this uses a preflight which simulates the cost of starting Maya and
+opening a scene. Pass ``--maya FILE`` to use Maya for real. Must be run against
+the local farm (or a real one)::
+
+    $ QBFUTURES_LOCALFARM=4 python -m qbfutures.test.fork_benchmark
+
+"""
+
+import time
+from optparse import OptionParser
+
+from .. import core
+
+
+# We are usually run as __main__, so refer to ourselves by name.
+MODULE = 'qbfutures.test.fork_benchmark'
+
+# The "scene" opened by the simulated preflight.
+scene = None
+
+
+def preflight(package):
+    global scene
+    time.sleep(float(package.get('preflight_cost') or 0))
+    scene = {'nodes': ['persp', 'top', 'front', 'side']}
+
+
+def touch_scene(i):
+    """Modify the scene, and report whether it was pristine beforehand."""
+    if scene is None:
+        from maya import cmds
+        pristine = not cmds.ls('qbfuturesBenchmark*')
+        cmds.createNode('transform', name='qbfuturesBenchmark%d' % i)
+    else:
+        pristine = len(scene['nodes']) == 4
+        scene['nodes'].append('node%d' % i)
+    return pristine
+
+
+class Executor(core.Executor):
+
+    def __init__(self, preflight_cost, **kwargs):
+        super(Executor, self).__init__(**kwargs)
+        self.preflight_cost = preflight_cost
+
+    def _base_work_package(self, func, args=None, kwargs=None, extra={}):
+        package = super(Executor, self)._base_work_package(func, args, kwargs, extra)
+        package['preflight'] = '%s:preflight' % MODULE
+        package['preflight_cost'] = self.preflight_cost
+        return package
+
+
+MODES = [
+    ('fresh', {}),
+    ('reuse', {'reuse_child': True}),
+    ('fork', {'fork_server': True}),
+]
+
+
+def main():
+
+    opt_parser = OptionParser()
+    opt_parser.add_option('-n', '--count', type='int', default=20)
+    opt_parser.add_option('-c', '--cpus', type='int', default=2)
+    opt_parser.add_option('--preflight-cost', type='float', default=1.0)
+    opt_parser.add_option('--maya')
+    opts, args = opt_parser.parse_args()
+
+    print '%-6s %8s %8s %10s' % ('mode', 'total', 'per-task', 'pristine')
+    for mode, kwargs in MODES:
+
+        if opts.maya:
+            from ..maya import Executor as MayaExecutor
+            executor = MayaExecutor(filename=opts.maya, cpus=opts.cpus, **kwargs)
+        else:
+            executor = Executor(opts.preflight_cost, cpus=opts.cpus, **kwargs)
+
+        start = time.time()
+        results = list(executor.map('%s:touch_scene' % MODULE, xrange(opts.count)))
+        elapsed = time.time() - start
+
+        print '%-6s %8.3f %8.3f %10s' % (mode, elapsed, elapsed / opts.count, '%d/%d' % (sum(results), len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Microbenchmarks of pack/unpack throughput on representative payloads.
+
+Only :mod:`qbfutures.utils` is exercised, but importing the package requires
+Qube, so run it against the local farm (which is never used) where Qube isn't
+installed::
+
+    $ QBFUTURES_LOCALFARM=1 python -m qbfutures.test.pack_benchmark
+
+"""
+
+import random
+import time
+
+from .. import utils
+
+
+def make_payloads():
+    
+    rand = random.Random(1234)
+    
+    transforms = ['|group%d|pCube%d_transform' % (i // 20, i) for i in xrange(5000)]
+    
+    matrices = dict(
+        ('pCube%d' % i, [rand.choice((0.0, 1.0, rand.random())) for _ in xrange(16)])
+        for i in xrange(2000)
+    )
+    
+    frames = [{
+        'frame': i,
+        'camera': 'renderCam',
+        'layers': ['beauty', 'diffuse', 'specular'],
+        'output': '/mnt/projects/show/seq/shot/render/v%03d/beauty.%04d.exr' % (i % 10, i),
+    } for i in xrange(1000)]
+    
+    return [
+        ('args', {'func': 'qbfutures.test.work:func', 'args': (1, 'two'), 'kwargs': {}}),
+        ('transforms', {'result': transforms, 'status': 'complete'}),
+        ('matrices', {'result': matrices, 'status': 'complete'}),
+        ('frames', {'args': (frames, ), 'kwargs': {}}),
+        ('noise', {'result': ''.join(chr(rand.randrange(256)) for _ in xrange(1 << 20)), 'status': 'complete'}),
+    ]
+
+
+def bench(func, *args):
+    count = 0
+    start = time.time()
+    while True:
+        func(*args)
+        count += 1
+        elapsed = time.time() - start
+        if elapsed > 0.5:
+            return elapsed / count
+
+
+def main():
+    
+    formats = [(s, c) for s in sorted(utils._serializers) for c in [None] + sorted(utils._compressors)]
+    
+    print '%-12s %-20s %10s %10s %10s %10s' % ('payload', 'format', 'bytes', 'ratio', 'pack MB/s', 'unpack MB/s')
+    for name, payload in make_payloads():
+        raw_size = len(utils.pack(payload, compression='')['__pickle__'])
+        for serializer, compression in formats:
+            packed = utils.pack(payload, serializer=serializer, compression=compression or '')
+            size = len(packed['__pickle__'])
+            pack_time = bench(utils.pack, payload, serializer, compression or '')
+            unpack_time = bench(utils.unpack, packed)
+            print '%-12s %-20s %10d %10.2f %10.1f %10.1f' % (
+                name,
+                '+'.join(filter(None, (serializer, compression))),
+                size,
+                float(raw_size) / size,
+                raw_size / pack_time / 1e6,
+                raw_size / unpack_time / 1e6,
+            )
+
+
+if __name__ == '__main__':
+    main()
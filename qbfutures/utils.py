@@ -1,6 +1,26 @@
+import bz2
+import os
 import re
+import uuid
+import zlib
 import cPickle as pickle
 
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+
+# Defaults for packing; the environment variables are passed through to jobs
+# so that results are packed the same way.
+SERIALIZER = os.environ.get('QBFUTURES_SERIALIZER', 'pickle')
+PICKLE_PROTOCOL = int(os.environ.get('QBFUTURES_PICKLE_PROTOCOL', pickle.HIGHEST_PROTOCOL))
+COMPRESSION = os.environ.get('QBFUTURES_COMPRESSION', 'zlib')
+COMPRESSION_THRESHOLD = int(os.environ.get('QBFUTURES_COMPRESSION_THRESHOLD', 4096))
+
+# Strings longer than this are elided from the human readable part of packages.
+CLEAN_MAX_STRING = 1024
+
 
 def extend(target, *args, **kwargs):
     for arg in args:
@@ -9,6 +29,26 @@ def extend(target, *args, **kwargs):
     return target
 
 
+def atomic_write(path, data):
+    """Write data to a file so that nobody ever sees it partially written.
+    
+    It is written under a unique temporary name (ending in ``.tmp``) in the
+    same directory, and then renamed into place.
+    
+    """
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 def get_func(spec):
     if not isinstance(spec, basestring):
         return spec
@@ -27,13 +67,132 @@ def get_func_name(spec):
     return '%s.%s' % (getattr(spec, '__module__', '__module__'), getattr(spec, '__name__', str(spec)))
     
 
+def get_shared_package(job, package):
+    """Get the job-level package that holds the shared parts of a work package.
+    
+    Maps store the parts of the call which are common to every item (e.g. the
+    function and interpreter) once on the job, and each work item refers to
+    them by key. Returns an empty dict if the work package does not.
+    
+    """
+    key = package.get('shared')
+    if key is None:
+        return {}
+    return (job.get('package') or {})[key]
+
+
+class FutureRef(object):
+
+    """Stands in for a :class:`~qbfutures.Future` passed as an argument,
+    until the worker replaces it with the result of that future's work.
+
+    :param int index: The call within the work item, if it is a chunk.
+
+    """
+
+    def __init__(self, job_id, work_id, index=None):
+        self.job_id = job_id
+        self.work_id = work_id
+        self.index = index
+
+    @property
+    def key(self):
+        return '%d:%d' % (self.job_id, self.work_id)
+
+    def __repr__(self):
+        index = '' if self.index is None else '[%d]' % self.index
+        return '<FutureRef %s%s>' % (self.key, index)
+
+
+class Continuation(object):
+
+    """Returned by a function on the farm to finish its future with the result
+    of another call, made once the futures in its arguments have finished.
+
+    The work item finishes right away, releasing its slot on the farm, and the
+    follow-up call is submitted as a new job which waits on Qube for those
+    futures (see :meth:`Executor.submit_ext <qbfutures.Executor.submit_ext>`
+    for the arguments)::
+
+        >>> def process_shot(shot):
+        ...     executor = qbfutures.Executor()
+        ...     frames = [executor.submit(render_frame, shot, frame) for frame in shot.frames]
+        ...     return qbfutures.Continuation(encode_movie, [frames])
+
+    """
+
+    def __init__(self, func, args=None, kwargs=None, **extra):
+        self.func = func
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.extra = extra
+
+
+_serializers = {}
+_compressors = {}
+
+
+def register_serializer(name, dumps, loads):
+    """Register functions to turn objects into strings, and back again.
+    
+    The name is recorded in every package which uses it, so it must be
+    registered under the same name wherever those packages are unpacked. Names
+    may not contain a ``+``.
+    
+    """
+    _serializers[name] = (dumps, loads)
+
+
+def register_compressor(name, compress, decompress):
+    """Register functions to compress serialized strings, and back again."""
+    _compressors[name] = (compress, decompress)
+
+
+register_serializer('pickle', lambda x: pickle.dumps(x, PICKLE_PROTOCOL), pickle.loads)
+if cloudpickle is not None:
+    register_serializer('cloudpickle', lambda x: cloudpickle.dumps(x, PICKLE_PROTOCOL), pickle.loads)
+register_compressor('zlib', zlib.compress, zlib.decompress)
+register_compressor('bz2', bz2.compress, bz2.decompress)
+
+
+def serialize(obj, serializer=None, compression=None, threshold=None):
+    """Serialize an object, returning the data and the format to unserialize it with.
+    
+    Data smaller than the threshold (or that does not get any smaller) is
+    not compressed.
+    
+    """
+    
+    format_ = serializer or SERIALIZER
+    data = _serializers[format_][0](obj)
+    
+    compression = COMPRESSION if compression is None else compression
+    threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+    if compression and len(data) >= threshold:
+        compressed = _compressors[compression][0](data)
+        if len(compressed) < len(data):
+            data = compressed
+            format_ = '%s+%s' % (format_, compression)
+    
+    return data, format_
+
+
+def unserialize(data, format_='pickle'):
+    serializer = format_.split('+')
+    for compression in reversed(serializer[1:]):
+        data = _compressors[compression][1](data)
+    return _serializers[serializer[0]][1](data)
+
+
 def _clean_for_pack(x):
     if x is None:
         return x
+    if isinstance(x, str) and len(x) > CLEAN_MAX_STRING:
+        return '<<%d bytes>>' % len(x)
     if isinstance(x, (int, float, str, bool)):
         return x
     if isinstance(x, unicode):
-        return x.encode('utf8')
+        return _clean_for_pack(x.encode('utf8'))
     if isinstance(x, (list, tuple, set)):
         return type(x)(_clean_for_pack(v) for v in x)
     if isinstance(x, dict):
@@ -41,15 +200,20 @@ def _clean_for_pack(x):
     return '<<%r>>' % x
 
 
-def pack(package):
+def pack(package, serializer=None, compression=None):
     package = dict(package)
     package.pop('__pickle__', None)
+    package.pop('__format__', None)
     cleaned = dict((k, _clean_for_pack(v)) for k, v in package.iteritems())
-    cleaned['__pickle__'] = pickle.dumps(dict(package), -1).encode('base64')
+    data, format_ = serialize(package, serializer, compression)
+    cleaned['__pickle__'] = data.encode('base64')
+    # Plain pickles are left unmarked, as they always were.
+    if format_ != 'pickle':
+        cleaned['__format__'] = format_
     return cleaned
 
 
 def unpack(package):
     if '__pickle__' in package:
-        return pickle.loads(package['__pickle__'].decode('base64'))
+        return unserialize(package['__pickle__'].decode('base64'), package.get('__format__', 'pickle'))
     return dict(package)
@@ -1,8 +1,12 @@
 from __future__ import absolute_import
 
 import cPickle as pickle
+import cProfile
+import fcntl
+import functools
 import os
 import pprint
+import struct
 import subprocess
 import sys
 import time
@@ -11,6 +15,8 @@ import gc
 
 import qb
 
+from . import notify
+from . import spool
 from . import utils
 
 
@@ -53,6 +59,211 @@ if _debug:
     qb = MockQB()
 
 
+def merge_package(job, package):
+    """Get a work package merged over the shared package it refers to.
+    
+    Neither are unpacked, so this is only useful for inspecting the keys that
+    are visible before unpacking.
+    
+    """
+    merged = dict(utils.get_shared_package(job, package))
+    merged.update(package)
+    return merged
+
+
+# The ``(status, resultpackage)`` of finished work which our agenda depends on,
+# by ``"job_id:work_id"``, so that each upstream job is only fetched once.
+_finished_upstream = {}
+
+
+def fetch_upstream(job, package):
+    """Fetch the results of the work which the given package depends on.
+    
+    This is done by the worker, since it can always talk to Qube.
+    
+    :returns: A dict mapping ``"job_id:work_id"`` to ``(status, resultpackage)``,
+        or ``None`` if there are no dependencies.
+    
+    """
+    
+    keys = set(utils.get_shared_package(job, package).get('depends') or ())
+    keys.update(package.get('depends') or ())
+    if not keys:
+        return None
+    
+    upstream = {}
+    
+    # Work which handed off to a follow-up call (see qbfutures.Continuation)
+    # finished before its result exists, so we have to wait for it. The
+    # dependency was only on the original job, since we couldn't know.
+    waiting = dict((key, key) for key in keys)
+    delay = 0.1
+    while waiting:
+        
+        # Only ask about jobs with work we haven't already seen finish, and
+        # remember all of their finished work for the rest of our agenda.
+        polling, waiting = waiting, {}
+        pending = set()
+        job_ids = sorted(set(int(key.split(':')[0]) for key in polling if key not in _finished_upstream))
+        if job_ids:
+            for upstream_job in qb.jobinfo(id=job_ids, agenda=True):
+                for work_id, work in enumerate(upstream_job['agenda']):
+                    work_key = '%d:%d' % (upstream_job['id'], work_id)
+                    if work['status'] in ('complete', 'failed', 'killed'):
+                        _finished_upstream[work_key] = (work['status'], work.get('resultpackage'))
+                    else:
+                        pending.add(work_key)
+        
+        # Anything which isn't found is left out, and reported as missing.
+        for work_key, key in polling.iteritems():
+            finished = _finished_upstream.get(work_key)
+            if finished is None:
+                if work_key in pending:
+                    waiting[work_key] = key
+                continue
+            status, resultpackage = finished
+            continuation = (resultpackage or {}).get('continuation')
+            if continuation and status == 'complete':
+                waiting['%(job_id)d:%(work_id)d' % continuation] = key
+                continue
+            upstream[key] = finished
+        
+        if waiting:
+            log('waiting on upstream work %s' % ', '.join(sorted(waiting)))
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+    
+    return upstream
+
+
+def resolve_futures(obj, upstream, results=None):
+    """Replace :class:`~qbfutures.utils.FutureRef` within arguments with the
+    results they refer to, raising the exception of any that failed.
+    
+    """
+    
+    results = {} if results is None else results
+    
+    if isinstance(obj, utils.FutureRef):
+        
+        result = results.get(obj.key)
+        if result is None:
+            status, resultpackage = upstream.get(obj.key) or (None, None)
+            if not resultpackage:
+                raise RuntimeError('upstream work %s is %s' % (obj.key, status or 'missing'))
+            result = utils.unpack(resultpackage)
+            if 'spool' in result:
+                result = spool.load(result['spool'])
+            results[obj.key] = result
+        
+        if 'exception' in result:
+            raise result['exception']
+        value = result['result']
+        if obj.index is not None:
+            if obj.index in (result.get('failed') or ()):
+                raise value[obj.index]
+            value = value[obj.index]
+        return value
+    
+    if type(obj) in (list, tuple):
+        return type(obj)(resolve_futures(x, upstream, results) for x in obj)
+    if type(obj) is dict:
+        return dict((k, resolve_futures(v, upstream, results)) for k, v in obj.iteritems())
+    return obj
+
+
+def send_frame(fh, obj):
+    """Send a length-prefixed pickle over the given pipe."""
+    send_frame_data(fh, pickle.dumps(obj, -1))
+
+
+def send_frame_data(fh, data):
+    fh.write(struct.pack('!Q', len(data)))
+    fh.write(data)
+    fh.flush()
+
+
+def recv_frame(fh):
+    """Receive a length-prefixed pickle from the given pipe.
+    
+    :raises EOFError: When the other end has been closed.
+    
+    """
+    header = fh.read(8)
+    if len(header) < 8:
+        raise EOFError('pipe closed')
+    size = struct.unpack('!Q', header)[0]
+    data = fh.read(size)
+    if len(data) < size:
+        raise EOFError('pipe closed mid-frame')
+    return pickle.loads(data)
+
+
+class Child(object):
+    
+    """A child process which executes packages sent to it over a pipe.
+    
+    The child will continue to execute packages until its request pipe is
+    closed, so it may be reused for work items which require the same
+    interpreter and preflight.
+    
+    """
+    
+    def __init__(self, interpreter, key=None):
+        
+        self.key = key
+        
+        # Prepare some pipes for communicating with the subprocess. Our ends
+        # must not be inherited by any other children, or this child will not
+        # see them close.
+        request_pipe = os.pipe()
+        response_pipe = os.pipe()
+        for fd in (request_pipe[1], response_pipe[0]):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        
+        # Open the process, doing a dev bootstrap if this is a dev environment.
+        # We are calling this module, which will end up calling the
+        # :func:`execute` function.
+        cmd = []
+        if 'VEE_EXEC_ARGS' in os.environ or 'KS_DEV_ARGS' in os.environ:
+            # These both have a "dev" command with a "--bootstrap" which do
+            # the same thing.
+            cmd.extend(('dev', '--bootstrap'))
+        cmd.extend((
+            interpreter,
+            '-m', 'qbfutures.sandbox.the_corner',
+            str(request_pipe[0]), str(response_pipe[1]),
+        ))
+        log('spawning child: %s' % subprocess.list2cmdline(cmd))
+        self.proc = subprocess.Popen(cmd, close_fds=False)
+        
+        # Close our end of the pipes so that there is only one process which
+        # still has them open (the child).
+        os.close(request_pipe[0])
+        os.close(response_pipe[1])
+        
+        self.request_fh = os.fdopen(request_pipe[1], 'w')
+        self.response_fh = os.fdopen(response_pipe[0], 'r')
+    
+    def is_alive(self):
+        return self.proc.poll() is None
+    
+    def send(self, obj):
+        send_frame(self.request_fh, obj)
+    
+    def recv(self):
+        return recv_frame(self.response_fh)
+    
+    def close(self):
+        """Close the pipes, and wait for the child to finish."""
+        for fh in (self.request_fh, self.response_fh):
+            try:
+                fh.close()
+            except IOError:
+                pass
+        self.proc.wait()
+
+
 def main():
     """The main worker, responsible for all direct communication with Qube.
     
@@ -75,6 +286,9 @@ def main():
     job_for_child = dict(job)
     job_for_child.pop('agenda', None)
     
+    # The child which is currently running, if any.
+    child = None
+    
     # The main loop. Continuously request more work and dispatch it to a child.
     # Keep on going until we are no longer given an agenda that we can operate
     # on.
@@ -96,6 +310,8 @@ def main():
             # 'complete' -> No more frames.
             # 'pending' -> Preempted, so bail out.
             # 'blocked' -> Perhaps item is part of a dependency.
+            if child is not None:
+                child.close()
             log('reporting job as %s' % agenda['status'])
             qb.reportjob(agenda['status'])
             log('worker shutting down')
@@ -114,58 +330,82 @@ def main():
         pprint.pprint(package_to_print)
         print '# ---'
         
-        # Prepare some pipes for communicating with the subprocess.
-        request_pipe = os.pipe()
-        response_pipe = os.pipe()
-        
-        # Open the process, doing a dev bootstrap if this is a dev environment.
-        # We are calling this module, which will end up calling the
-        # :func:`execute` function.
-        cmd = []
-        if 'VEE_EXEC_ARGS' in os.environ or 'KS_DEV_ARGS' in os.environ:
-            # These both have a "dev" command with a "--bootstrap" which do
-            # the same thing.
-            cmd.extend(('dev', '--bootstrap'))
-        cmd.extend((
-            agenda['package'].get('interpreter', 'python'),
-            '-m', 'qbfutures.sandbox.the_corner',
-            str(request_pipe[0]), str(response_pipe[1]),
-        ))
-        log('spawning child: %s' % subprocess.list2cmdline(cmd))
-        proc = subprocess.Popen(cmd, close_fds=False)
-        
-        # Close our end of the pipes so that there is only one process which
-        # still has them open (the child).
-        os.close(request_pipe[0])
-        os.close(response_pipe[1])
-        
-        # Send the job and agenda package to the child.
-        with os.fdopen(request_pipe[1], 'w') as request_fh:
-            pickle.dump(job_for_child, request_fh, -1)
-            pickle.dump(agenda['package'], request_fh, -1)
-        
-        # Get the response from the child.
-        with os.fdopen(response_pipe[0], 'r') as response_fh:
-            try:
-                package = pickle.load(response_fh)
-            except Exception as e:
-                traceback.print_exc()
-                sys.stderr.flush()
-                package = {
-                    'status': 'failed',
-                    'exception': e,
-                }
+        # Determine which child to run it in. Children may be reused for
+        # successive work items as long as they would be started the same way.
+        merged_package = merge_package(job, agenda['package'])
+        interpreter = merged_package.get('interpreter', 'python')
+        fork_server = bool(merged_package.get('fork_server'))
+        reuse_child = merged_package.get('reuse_child') or fork_server
+        child_key = (
+            interpreter,
+            merged_package.get('preflight'),
+            merged_package.get('filename'),
+            merged_package.get('workspace'),
+            tuple(sorted((job.get('env') or {}).items())),
+            fork_server,
+        )
+        
+        if child is not None and (not reuse_child or child.key != child_key or not child.is_alive()):
+            log('retiring child')
+            child.close()
+            child = None
+        
+        spawned_at = None
+        if child is None:
+            spawned_at = time.time()
+            child = Child(interpreter, child_key)
+        else:
+            log('reusing child %d' % child.proc.pid)
+        
+        # Send the job and agenda package (with the results it depends on) to
+        # the child, and get the response.
+        try:
+            package = agenda['package']
+            upstream = fetch_upstream(job, package)
+            if upstream is not None:
+                log('fetched %d upstream results' % len(upstream))
+                package = dict(package, upstream=upstream)
+            child.send((job_for_child, package))
+            package = child.recv()
+        except Exception as e:
+            traceback.print_exc()
+            sys.stderr.flush()
+            package = {
+                'status': 'failed',
+                'exception': e,
+            }
+            child.close()
+            child = None
+        received_at = time.time()
         
-        # Wait for the child to finish.
-        # log('waiting for child...')
-        proc.wait()
+        if child is not None and not reuse_child:
+            child.close()
+            child = None
         
         package.setdefault('status', 'failed')
+        
+        # Turn the child's timestamps into the time spent in each phase.
+        timings = package.pop('timings', None) or {}
+        ready_at = timings.pop('ready_at', None)
+        if spawned_at and ready_at:
+            timings['spawn'] = ready_at - spawned_at
+        finished_at = timings.pop('finished_at', None)
+        if finished_at:
+            timings['pickle'] = received_at - finished_at
+        
+        # The timings are left unpacked, so they can be read cheaply, and so
+        # they can include the packing itself.
+        start = time.time()
         agenda['resultpackage'] = utils.pack(package)
+        timings['pack'] = time.time() - start
+        agenda['resultpackage']['timings'] = timings
         agenda['status'] = package['status']
         
         log('work resultpackage')
-        pprint.pprint(package)
+        package_to_print = dict(package, timings=timings)
+        if 'profile' in package_to_print:
+            package_to_print['profile'] = '<<%d functions>>' % len(package['profile'])
+        pprint.pprint(package_to_print)
         print '# ---'
         
         if agenda['status'] == 'failed':
@@ -176,7 +416,15 @@ def main():
 
         log('reporting work as %s' % agenda['status'])
         
+        # This can't be included in the report itself, so we only log it.
+        start = time.time()
         qb.reportwork(agenda)
+        log('reported work in %.3fs' % (time.time() - start))
+        
+        # Let the client know right away, rather than waiting for it to poll.
+        notify_address = os.environ.get('QBFUTURES_NOTIFY_ADDRESS')
+        if notify_address:
+            notify.send(notify_address, job['id'], agenda['id'])
 
 
 def execute():
@@ -186,43 +434,173 @@ def execute():
     request_fh = os.fdopen(request_pipe, 'r')
     response_fh = os.fdopen(response_pipe, 'w')
     
+    # When we were ready to start on the first package, so the parent can tell
+    # how long it took us to start.
+    ready_at = time.time()
+    
+    # Keep executing packages until the parent closes the pipe. The parent only
+    # sends us packages with the same preflight, so it only needs to run once.
+    preflighted = False
+    while True:
+        
+        try:
+            job, package = recv_frame(request_fh)
+        except EOFError:
+            break
+        
+        timings = {}
+        if ready_at:
+            timings['ready_at'] = ready_at
+            ready_at = None
+        
+        # As a fork server, we run the preflight ourselves and then fork a
+        # fresh copy of ourselves to execute each package.
+        if merge_package(job, package).get('fork_server') and hasattr(os, 'fork'):
+            try:
+                if not preflighted:
+                    start = time.time()
+                    preflighted = run_preflight(job, package)
+                    timings['preflight'] = time.time() - start
+            except Exception as e:
+                traceback.print_exc()
+                timings['finished_at'] = time.time()
+                data = pickle.dumps({'exception': e, 'status': 'failed', 'timings': timings}, -1)
+            else:
+                data = execute_forked_package(job, package, timings)
+        else:
+            data, preflighted = execute_package(job, package, preflighted, timings)
+        
+        log('child sending result_package')
+        send_frame_data(response_fh, data)
+    
+    request_fh.close()
+    response_fh.close()
+        
+    log('child shutting down')
+        
+    # We are going to make a best effort to clean up Python, but we can't
+    # let it go through its normal process.
+    
+    # Run atexit.
+    if hasattr(sys, "exitfunc"):
+        sys.exitfunc()
+    
+    # Collect the highest generation that we can.
+    gc.collect(2)
+    
+    os._exit(0)
+
+
+def execute_package(job, package, preflighted=False, timings=None):
+    """Execute a single work package within the child.
+    
+    :param dict timings: Where to record the time spent in each phase; it is
+        sent back with the result.
+    :returns: The pickled result package, and whether the preflight has run.
+    
+    """
+    
     # Just in case someone calls `exit()` which won't be caught below.
     result_package = {'status': 'failed'}
+    spool_dir = None
+    timings = {} if timings is None else timings
+    profiler = None
+    upstream = package.get('upstream')
     
     try:
         
-        # Get the job/agenda package from the parent, but we cannot unpack it
-        # yet since the preflight may be required in order to setup the
-        # environment in which it can function.
-        job = pickle.load(request_fh)
-        package = pickle.load(request_fh)
-        
-        # Run any requested preflight functions.
-        preflight = package.get('preflight')
-        if preflight:
-            log('running preflight %s' % utils.get_func_name(package['preflight']))
-            sys.stdout.flush()
-            preflight = utils.get_func(preflight)
-            preflight(package)
-        
-        # Finally, unpack it.
-        package = utils.unpack(package)
+        # We were given the job/agenda package from the parent, but we cannot
+        # unpack it yet since the preflight may be required in order to setup
+        # the environment in which it can function.
+        if not preflighted:
+            start = time.time()
+            preflighted = run_preflight(job, package)
+            timings['preflight'] = time.time() - start
+        
+        # Finally, unpack it (along with the parts shared across the job).
+        start = time.time()
+        shared_package = utils.get_shared_package(job, package)
+        package = utils.extend(utils.unpack(shared_package), utils.unpack(package))
+        spool_dir, spool_threshold = spool.get_config(package)
+        timings['unpack'] = time.time() - start
         
         # Assemble the command to execute
         func = utils.get_func(package['func'])
         func_str = utils.get_func_name(package['func'])
         args = package.get('args') or ()
         kwargs = package.get('kwargs') or {}
+        chunk = package.get('chunk')
+        
+        # Substitute the results of any futures we were given. Those within a
+        # chunk are substituted call by call, so only those calls fail.
+        upstream_results = {}
+        if upstream:
+            args = resolve_futures(args, upstream, upstream_results)
+            kwargs = resolve_futures(kwargs, upstream, upstream_results)
+        
+        if package.get('profile'):
+            profiler = cProfile.Profile()
+            func = functools.partial(profiler.runcall, func)
+        
+        start = time.time()
+        
+        if chunk is None:
+            
+            # Print out what we are doing.
+            arg_spec = ', '.join([repr(x) for x in args] + ['%s=%r' % x for x in sorted(kwargs.iteritems())])
+            log('calling %s(%s)' % (func_str, arg_spec))
+            sys.stdout.flush()
+            
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                timings['execute'] = time.time() - start
+            
+            # Hand off to a follow-up call, so that we don't sit on this slot
+            # waiting for it.
+            if isinstance(result, utils.Continuation):
+                from . import core
+                continuation = core._submit_continuation(job, package, result)
+                log('continuing as %d:%d' % (continuation['job_id'], continuation['work_id']))
+                result_package = {
+                    'continuation': continuation,
+                    'status': 'complete',
+                }
+            else:
+                result_package = {
+                    'result': result,
+                    'status': 'complete',
+                }
         
-        # Print out what we are doing.
-        arg_spec = ', '.join([repr(x) for x in args] + ['%s=%r' % x for x in sorted(kwargs.iteritems())])
-        log('calling %s(%s)' % (func_str, arg_spec))
-        sys.stdout.flush()
-        
-        result_package = {
-            'result': func(*args, **kwargs),
-            'status': 'complete',
-        }
+        else:
+            
+            # Chunks call the function for every set of args, and the results
+            # have the exceptions for the calls listed in "failed".
+            log('calling %s over chunk of %d' % (func_str, len(chunk)))
+            sys.stdout.flush()
+            
+            results = []
+            failed = []
+            for i, args in enumerate(chunk):
+                try:
+                    if upstream:
+                        args = resolve_futures(args, upstream, upstream_results)
+                    result = func(*args, **kwargs)
+                    if isinstance(result, utils.Continuation):
+                        raise TypeError('continuations cannot be returned from chunked calls')
+                    results.append(result)
+                except Exception as e:
+                    traceback.print_exc()
+                    results.append(e)
+                    failed.append(i)
+            
+            timings['execute'] = time.time() - start
+            
+            result_package = {
+                'result': results,
+                'failed': failed,
+                'status': 'complete',
+            }
         
     except Exception as e:
         traceback.print_exc()
@@ -231,28 +609,81 @@ def execute():
             'status': 'failed',
         }
     
-        
-    log('child sending result_package')
+    if profiler is not None:
+        profiler.create_stats()
+        result_package['profile'] = profiler.stats
     
-    # Send the results to the child.
-    pickle.dump(result_package, response_fh, -1)
-        
-    request_fh.close()
-    response_fh.close()
-        
-    log('child shutting down')
-        
-    # We are going to make a best effort to clean up Python, but we can't
-    # let it go through its normal process.
-    
-    # Run atexit.
-    if hasattr(sys, "exitfunc"):
-        sys.exitfunc()
+    # The parent works out how long it took to get the result to it.
+    timings['finished_at'] = time.time()
+    result_package['timings'] = timings
     
-    # Collect the highest generation that we can.
-    gc.collect(2)
+    # Large results are sent via the spool, and we only send back where it is.
+    data = pickle.dumps(result_package, -1)
+    if spool_dir and len(data) > spool_threshold and 'continuation' not in result_package:
+        path = spool.write(spool_dir, data, prefix='%s.' % job.get('id', 'unknown'))
+        log('spooled %d bytes to %s' % (len(data), path))
+        removed = spool.sweep(spool_dir)
+        if removed:
+            log('swept %d old files from the spool' % removed)
+        stub = {'status': result_package['status'], 'spool': path, 'timings': timings}
+        if 'failed' in result_package:
+            stub['failed'] = result_package['failed']
+        data = pickle.dumps(stub, -1)
     
-    os._exit(0)
+    return data, preflighted
 
 
+def run_preflight(job, package):
+    """Run any preflight function requested by the given package.
+    
+    :returns: ``True``, since the preflight has been run.
+    
+    """
+    merged_package = merge_package(job, package)
+    preflight = merged_package.get('preflight')
+    if preflight:
+        log('running preflight %s' % utils.get_func_name(preflight))
+        sys.stdout.flush()
+        preflight = utils.get_func(preflight)
+        preflight(merged_package)
+    return True
 
+
+def execute_forked_package(job, package, timings=None):
+    """Execute a single work package within a forked copy of this process.
+    
+    Since the preflight has already run in this process, the fork starts with
+    it already done (e.g. with Maya initialized and the scene open), and any
+    changes it makes vanish with it.
+    
+    :returns: The pickled result package.
+    
+    """
+    
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(read_fd)
+            data, _ = execute_package(job, package, preflighted=True, timings=timings)
+            with os.fdopen(write_fd, 'w') as fh:
+                fh.write(data)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(0)
+    
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as fh:
+        data = fh.read()
+    _, status = os.waitpid(pid, 0)
+    
+    if not data:
+        data = pickle.dumps({
+            'exception': RuntimeError('forked child exited with status %d' % status),
+            'status': 'failed',
+        }, -1)
+    return data
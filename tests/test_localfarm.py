@@ -0,0 +1,73 @@
+"""Smoke tests which run work through the simulated local farm."""
+
+import os
+import unittest
+
+# The local farm must be enabled before qbfutures is first imported.
+os.environ.setdefault('QBFUTURES_LOCALFARM', '4')
+
+from concurrent.futures import CancelledError
+
+import qbfutures
+from qbfutures import core
+
+
+FUNC = 'qbfutures.test.work:func'
+TIMEOUT = 60
+
+
+class TestLocalFarm(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = core.Executor(name='QBFutures Smoke Test')
+
+    def test_submit(self):
+        future = self.executor.submit(FUNC, 'single')
+        self.assertEqual(future.result(TIMEOUT), ('single', ))
+        self.assertEqual(future.status(), 'complete')
+
+    def test_map(self):
+        results = self.executor.map(FUNC, range(10), timeout=TIMEOUT)
+        self.assertEqual(list(results), [(i, ) for i in range(10)])
+
+    def test_map_chunksize(self):
+        results = self.executor.map(FUNC, range(10), chunksize=3, timeout=TIMEOUT)
+        self.assertEqual(list(results), [(i, ) for i in range(10)])
+
+    def test_imap(self):
+        results = self.executor.imap(FUNC, iter(range(25)), jobsize=10, timeout=TIMEOUT)
+        self.assertEqual(list(results), [(i, ) for i in range(25)])
+
+    def test_imap_unordered(self):
+        results = self.executor.imap_unordered(FUNC, range(10), timeout=TIMEOUT)
+        self.assertEqual(sorted(results), [(i, ) for i in range(10)])
+
+    def test_batch(self):
+        with self.executor.batch('QBFutures Smoke Test: batch') as batch:
+            first = batch.submit(FUNC, 'first')
+            results = batch.map(len, ['hello', 'world!'])
+        self.assertEqual(first.result(TIMEOUT), ('first', ))
+        self.assertEqual(list(results), [5, 6])
+        self.assertEqual(len(set(future.job_id for future in batch.futures)), 1)
+
+    def test_failure(self):
+        future = self.executor.submit('qbfutures.test.fail:fail')
+        self.assertRaises(ValueError, future.result, TIMEOUT)
+        exception, _ = future.exception_info(TIMEOUT)
+        self.assertIsInstance(exception, ValueError)
+
+    def test_cancel(self):
+        future = self.executor.submit('time:sleep', 30)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(CancelledError, future.result, TIMEOUT)
+        self.assertEqual(future.status(refresh=True), 'killed')
+
+    def test_cancel_many(self):
+        futures = [self.executor.submit('time:sleep', 30) for i in range(3)]
+        qbfutures.cancel(futures)
+        self.assertTrue(all(future.cancelled() for future in futures))
+
+
+if __name__ == '__main__':
+    unittest.main()